@@ -25,3 +25,31 @@ scheduler_events = {
         "smm.tasks.activity.cast_activities"
     ]
 }
+
+
+# Start the headless Chrome pool of Crawler Feed Providers before jobs, see `smm_crawler_warm`
+before_job = [
+    "smm.libs.crawler.warm"
+]
+
+# Keep the dispatcher time wheel in sync with Network Activities, see `smm_dispatcher`,
+# and run the next step of the pipeline right after a change is committed, see `smm.libs.events`
+doc_events = {
+    "Network Activity": {
+        "after_insert": ["smm.libs.dispatcher.sync", "smm.libs.events.activity_changed"],
+        "on_update": ["smm.libs.dispatcher.sync", "smm.libs.events.activity_changed", "smm.libs.events.plan_inputs_changed"],
+        "on_trash": ["smm.libs.dispatcher.sync", "smm.libs.events.plan_inputs_changed"]
+    },
+    "Network Activity Plan": {
+        "on_update": "smm.libs.events.plan_changed"
+    },
+    "Agent": {
+        "on_update": "smm.libs.events.plan_inputs_changed"
+    },
+    "Content Mechanism": {
+        "on_update": "smm.libs.events.plan_inputs_changed"
+    },
+    "Feed": {
+        "after_insert": "smm.libs.events.feeds_added"
+    }
+}
@@ -1,12 +1,14 @@
 import copy
 import datetime
+import os
 import random
+import socket
 
 import frappe
 from frappe import _
 from frappe.utils import get_site_name
 
-from . import facebook, openai, telegrambot, utils, x
+from . import dispatcher, facebook, http, lock, openai, pool, telegrambot, utils, x
 
 # Based on the type of Network Activity, the required fields are different
 requirements = {
@@ -45,6 +47,46 @@ props = {
 }
 
 
+# Fields that tell the Network Activities of one combination of a plan of `activity_type` apart, `plan` and `activity` share a field
+def slot_fields(activity_type):
+    fields = [props.get(item).get("field_name") or item for item in requirements.get(activity_type) or [] if props.get(item)]
+    return list(dict.fromkeys(["agent"] + fields))
+
+
+# Latest schedule and number of Pending Activities of each combination of `fields` in a plan, see `ActivityPlan.load_slots`
+def slots_query(fields):
+    columns = ", ".join(f"`{field}`" for field in fields)
+    return f"""
+        select {columns}, max(`schedule`) as latest,
+            sum(`status` in ('Pending', 'Processing') and `schedule` >= %(now)s) as pending
+        from `tabNetwork Activity`
+        where `plan` = %(plan)s
+        group by {columns}
+    """
+
+
+# Successful posts of a plan with the agents that engaged with them, see `ActivityPlan.load_engagements`
+ENGAGEMENTS_QUERY = """
+    select candidate.name, candidate.agent as author, engagement.agent
+    from `tabNetwork Activity` candidate
+    left join `tabNetwork Activity` engagement
+        on engagement.activity = candidate.name
+        and engagement.agent in %(agents)s
+        and engagement.type in ('Post Comment', 'Share Content')
+        and engagement.status in ('Pending', 'Processing', 'Success')
+    where candidate.plan = %(plan)s
+        and candidate.type = 'Post Content'
+        and candidate.status = 'Success'
+"""
+
+# Expired leases, see `reclaim`
+RECLAIM_QUERY = """
+    update `tabNetwork Activity`
+    set status = 'Pending', lease_owner = null, lease_expires = null
+    where status = 'Processing' and lease_expires < %(now)s
+"""
+
+
 class ActivityPlan:
     def __init__(self, **args):
         self.name = utils.find(args, "name")
@@ -83,10 +125,7 @@ class ActivityPlan:
         self.duration = datetime.timedelta(seconds=self.doc.duration) if self.doc.duration else datetime.timedelta()
 
         # Get agents
-        self.agents = set()
-
-        # Get agents
-        self.agents.update(frappe.get_doc("Agent", item.agent) for item in self.doc.agents)
+        agent_names = [item.agent for item in self.doc.agents]
 
         # Get agents from agent groups
         
@@ -101,7 +140,18 @@ class ActivityPlan:
                 & (agent_group_item.parentfield == "agent_groups")
             )
             agents = query.run(as_dict=True)
-            self.agents.update(frappe.get_doc("Agent", item.parent) for item in agents)
+            agent_names.extend(item.parent for item in agents)
+
+        # Load all agents with one query
+        self.agents = {}
+        if agent_names:
+            for agent in frappe.get_all("Agent", filters={"name": ["in", list(set(agent_names))]}, fields=["name", "provider"]):
+                self.agents[agent.name] = agent
+
+        # Linked items are loaded once per plan and shared by every agent, see `linked_items`
+        self.children = {}
+        self.documents = {}
+        self.engagements = {}
     
 
     # This function is used to loop through each item of each array
@@ -137,30 +187,54 @@ class ActivityPlan:
         # Generate filters from context
         filters = {}
         for key, value in context.items():
-            filters[key] = value.name if isinstance(value, frappe.model.document.Document) else value
-
-        # Count the number of Pending Activities of the Agent for these filters upto the current date
-        pending_activities = frappe.db.count(
-            "Network Activity",
-            {
-                "plan": self.name,
-                "agent": agent.name,
-                "status": "Pending",
-                "schedule": [">=", self.current_datetime],
-                **filters
-            }
-        )
+            filters[key] = value.name if isinstance(value, (frappe.model.document.Document, dict)) else value
+
+        # Activities of this combination are looked up in the slot planner, see `load_slots`
+        key = self.slot_key(filters)
+        slot = self.slots.get(key) or {}
 
         # If there is already a Pending Activity, don't create new one
-        if pending_activities >= 1:
+        if slot.get("pending"):
             return
 
+        linked_activity_schedule = context.get("activity").schedule if context.get("activity") else None
+        schedule_datetime = self.next_slot(slot.get("latest"), linked_activity_schedule)
+        if schedule_datetime is None:
+            return
+
+        # Generate Network Activity
+        frappe.get_doc({
+            "owner": self.owner,
+            "doctype": "Network Activity",
+            "enabled": True,
+            "plan": self.name,
+            "agent": agent.name,
+            "schedule": schedule_datetime,
+            "status": "Pending",
+            **filters
+        }).insert()
+        frappe.db.commit()
+        self.slots[key] = {"latest": max(schedule_datetime, slot.get("latest") or schedule_datetime), "pending": 1}
+
+    # Fields that tell the Network Activities of one combination apart
+    def slot_key(self, filters):
+        return tuple(filters.get(field) for field in self.slot_fields)
+
+    # Slot planner: one grouped query loads the latest schedule and the number of Pending Activities of each combination of the plan,
+    # `next_slot` then finds the schedule of a new Network Activity in memory
+    def load_slots(self, fields):
+        self.slot_fields = list(dict.fromkeys(["agent"] + list(fields)))
+        rows = frappe.db.sql(slots_query(self.slot_fields), {"plan": self.name, "now": self.current_datetime}, as_dict=True)
+        self.slots = {self.slot_key(row): row for row in rows}
+
+    # The nearest schedule within the plan's dates and daily time range, at least `duration` after the latest Network Activity
+    # of the combination and not before the linked Network Activity. None when the plan ends before that.
+    def next_slot(self, latest=None, linked_activity_schedule=None):
         base_date = self.base_date
         # If `activity` field exists, get the latest Network Activity scheduled datetime and set it as the base date if possible.
-        linked_activity_schedule = self.current_datetime
-        if context.get("activity"):
-            linked_activity_schedule = context.get("activity").schedule
+        if linked_activity_schedule:
             base_date = max(base_date, linked_activity_schedule.date())
+        linked_activity_schedule = linked_activity_schedule or self.current_datetime
 
         # The chosen date and timeframe is the nearest one that is possible to create new Network Activity into
         # Loop through each date, started from the date of the current date or Plan start date depending on which one is bigger
@@ -171,40 +245,23 @@ class ActivityPlan:
 
             # Break if the Network Activity Plan has end date and is expired
             if self.end_date and date > self.end_date:
-                break
+                return None
 
             # Set schedule datetime to the nearest possible schedule
             # The schedule datetime is the maximum value between the current datetime and the start datetime of the Network Activity Plan
             schedule_datetime = utils.comebine_datetime(date, max(self.current_time if date == self.current_date else self.start_time, self.start_time))
             schedule_datetime = max(schedule_datetime, linked_activity_schedule)
 
-            # Get the latest Network Activity scheduled datetime within the daily timeframe, based on Agent, Network Activity Plan
+            # The latest Network Activity within the daily timeframe is combined with duration to get the next possible schedule
             # WHY DO WE NEED THIS? Because we don't want to duplicate Network Activity within the same timeframe
-            latest_activity = frappe.db.get_list(
-                "Network Activity",
-                filters={
-                    "plan": self.name,
-                    "agent": agent.name,
-                    "schedule": ["<=", utils.comebine_datetime(date, self.end_time)],
-                    **filters
-                },
-                fields=["name", "schedule", "status"],
-                order_by="schedule desc",
-                limit_page_length=1
-            )
+            if latest and latest <= utils.comebine_datetime(date, self.end_time):
+                schedule_datetime = max(latest + self.duration, schedule_datetime)
 
-            # The latest Network Activity schedule is then combined with duration to get the next possible schedule
-            # The next possible schedule is then compared with the current datetime to get the nearest possible schedule
-            if len(latest_activity) > 0:
-                latest_activity_datetime = latest_activity[0].schedule
-                if latest_activity_datetime:
-                    schedule_datetime = max(latest_activity_datetime + self.duration, schedule_datetime)
-            
             schedule_date = schedule_datetime.date()
             schedule_time = datetime.timedelta(hours=schedule_datetime.hour, minutes=schedule_datetime.minute, seconds=schedule_datetime.second)
 
             if self.end_date and schedule_date > self.end_date:
-                break
+                return None
 
             if schedule_date > date:
                 day += (schedule_date - date).days
@@ -214,43 +271,70 @@ class ActivityPlan:
                 day += 1
                 continue
 
-            # Generate Network Activity and break the loop
-            frappe.get_doc({
-                "owner": self.owner,
-                "doctype": "Network Activity",
-                "enabled": True,
-                "plan": self.name,
-                "agent": agent.name,
-                "schedule": schedule_datetime,
-                "status": "Pending",
-                **filters
-            }).insert()
-            frappe.db.commit()
-            break
-    
+            return schedule_datetime
+
+    # Children of a linked item. Children found by filters are the same for every agent and are only queried once per plan.
+    def linked_items(self, field, context):
+        # Check if the field has its own query function
+        # This is used when the query is more complex than just getting the list of linked items
+        # The function must return an array of linked items
+        if field.get("query") is not None and hasattr(self, field.get("query")) and callable(getattr(self, field.get("query"))):
+            return getattr(self, field.get("query"))(context) or []
+
+        key = (field.get("parent_field"), context.get("linked_item").name)
+        if key not in self.children:
+            # Create a full copy of the original filters map and generate filters from it
+            filters = {}
+            if field.get("filters") is not None:
+                filters = utils.transform(
+                    copy.deepcopy(field.get("filters")),
+                    context
+                )
+            # Get the list of linked items using the generated filters
+            # This part needs improvement to be able to get the list of linked items with deeper filters
+            self.children[key] = frappe.db.get_list(field.get("child_doctype"), filters=filters)
+        return self.children[key]
+
+    # Load the fields the generator reads (`enabled`, `schedule`) of linked items with one query per doctype, cached for the plan
+    def load_documents(self, doctype, names):
+        documents = self.documents.setdefault(doctype, {})
+        missing = list(set(name for name in names if name not in documents))
+        if missing:
+            meta = frappe.get_meta(doctype)
+            fields = ["name"] + [field for field in ["enabled", "schedule"] if meta.has_field(field)]
+            for document in frappe.get_all(doctype, filters={"name": ["in", missing]}, fields=fields):
+                documents[document.name] = document
+        return documents
+
     # Custom query function for `plan` field
+    # Successful "Post Content" activities of the linked plan from other agents that the agent hasn't replied to or shared yet.
+    # Computed once per linked plan for all agents of this plan, each agent gets its slice from memory.
     def plan_query(self, context={}):
-        doctype = frappe.qb.DocType(context.get("field").get("child_doctype"))
         plan = context.get("linked_item").get("plan")
         agent = context.get("agent").get("name")
 
-        # Get the list of Network Activities created by the agent
-        subquery = frappe.qb.from_(doctype).select(doctype.activity).distinct().where(
-            (doctype.agent == agent) &
-            doctype.type.isin(["Post Comment", "Share Content"]) &
-            doctype.status.isin(["Pending", "Success"])
-        )
-        
-        # Get the list of Network Activities created by other agents that are not in the list of Network Activities created by the agent
-        query = frappe.qb.from_(doctype).select(doctype.name).distinct().where(
-            (doctype.plan == plan) &
-            (doctype.agent != agent) &
-            (doctype.type == "Post Content") &
-            (doctype.status == "Success") &
-            doctype.name.notin(subquery)
-        ).run(as_dict=True)
-
-        return query
+        if plan not in self.engagements:
+            self.engagements[plan] = self.load_engagements(plan)
+        candidates, engaged = self.engagements[plan]
+
+        return [
+            frappe._dict(name=name) for name, author in candidates.items()
+            if author != agent and agent not in engaged.get(name, ())
+        ]
+
+    # Candidate activities of a plan with their author, and the agents of this plan that already engaged with each of them.
+    # One LEFT JOIN returns a row per candidate and engaging agent, or a single row with no agent for untouched candidates.
+    def load_engagements(self, plan):
+        candidates = {}
+        engaged = {}
+        if not self.agents:
+            return candidates, engaged
+        rows = frappe.db.sql(ENGAGEMENTS_QUERY, {"plan": plan, "agents": tuple(self.agents.keys())}, as_dict=True)
+        for row in rows:
+            candidates[row.name] = row.author
+            if row.agent:
+                engaged.setdefault(row.name, set()).add(row.agent)
+        return candidates, engaged
     
     
     def schedule(self):
@@ -261,9 +345,12 @@ class ActivityPlan:
         # Switch through value of Activity Type
         activity_type = self.doc.activity_type
         required_fields = requirements.get(activity_type)
+
+        # Load the slots of every combination of the plan at once
+        self.load_slots(slot_fields(activity_type))
             
         # Generate one Network Activity for each Agent and for each item of each other required field
-        for agent in self.agents:
+        for agent in self.agents.values():
             # fields must be dictionary to be able to store unique data
             fields = {}
             if required_fields is not None and len(required_fields) > 0:
@@ -277,38 +364,18 @@ class ActivityPlan:
                         # If field type is array, get the linked items
                         if field.get("type") == "array" and field.get("child_doctype"):
                             # Linked Item is an Item of the parent Table field which is linked to a child Doctype
+                            names = []
                             for linked_item in self.doc.get(field.get("parent_field")):
-                                children = None
                                 context = {"field": field, "agent": agent, "linked_item": linked_item}
-                                
-                                # Check if the field has its own query function
-                                # This is used when the query is more complex than just getting the list of linked items
-                                # The function must return an array of linked items
-                                if field.get("query") is not None and hasattr(self, field.get("query")) and callable(getattr(self, field.get("query"))):
-                                    children = getattr(self, field.get("query"))(context)
-                                
-                                # If the field doesn't have its own query function, generate filters from context and get the list of linked items
-                                else:
-                                    # Create a full copy of the original filters map and generate filters from it
-                                    filters = {}
-                                    
-                                    if field.get("filters") is not None:
-                                        filters = utils.transform(
-                                            copy.deepcopy(field.get("filters")),
-                                            context
-                                        )
-                                
-                                    # Get the list of linked items using the generated filters
-                                    # This part needs improvement to be able to get the list of linked items with deeper filters
-                                    children = frappe.db.get_list(field.get("child_doctype"), filters=filters)
-                                
-                                if children is not None:
-                                    for child in children:
-                                        linked_item_doc = frappe.get_doc(field.get("child_doctype"), child.name)
-                                        # If `enabled` field doesn't exist or is 1, append the linked item to the array
-                                        # Make sure the linked item doesn't already exist in the array
-                                        if (linked_item_doc.enabled is None or linked_item_doc.enabled == 1) and fields[key].get("data").get(child.name) is None:
-                                            fields[key].get("data")[child.name] = linked_item_doc
+                                names.extend(child.name for child in self.linked_items(field, context))
+
+                            documents = self.load_documents(field.get("child_doctype"), names)
+                            for name in names:
+                                linked_item_doc = documents.get(name)
+                                # If `enabled` field doesn't exist or is 1, append the linked item to the array
+                                # Make sure the linked item doesn't already exist in the array
+                                if linked_item_doc and (linked_item_doc.enabled is None or linked_item_doc.enabled == 1) and fields[key].get("data").get(name) is None:
+                                    fields[key].get("data")[name] = linked_item_doc
 
                         # If field type is single, it is unique by default, so just get the value
                         # Make sure the value doesn't already exist in the array
@@ -327,8 +394,71 @@ class ActivityPlan:
 
 @frappe.whitelist()
 def generate_activity(**args):
-    activity_plan = ActivityPlan(**args)
-    activity_plan.schedule()
+    # Only one worker schedules a plan at a time
+    with lock.hold(f"plan:{utils.find(args, 'name')}") as acquired:
+        if not acquired:
+            return
+        started = frappe.utils.now_datetime()
+        activity_plan = ActivityPlan(**args)
+        if not hasattr(activity_plan, "doc") or activity_plan.doc.enabled == 0:
+            return
+        activity_plan.schedule()
+        evaluated(activity_plan.name, started)
+
+
+# Plans are only evaluated again once `next_evaluation_at` is due. Events mark a plan when one of its inputs changed (see
+# `events.plan_inputs_changed`), otherwise it is evaluated again after `smm_plan_evaluation_interval` seconds as a safety net.
+def mark_plans(names):
+    names = list(set(name for name in names if name))
+    if not names:
+        return
+    doctype = frappe.qb.DocType("Network Activity Plan")
+    frappe.qb.update(doctype).set(doctype.next_evaluation_at, frappe.utils.now_datetime()).where(doctype.name.isin(names)).run()
+
+
+# Changes marked while the plan was being evaluated keep it due
+def evaluated(name, started):
+    next_evaluation_at = frappe.utils.now_datetime() + datetime.timedelta(seconds=utils.conf("plan_evaluation_interval", 3600))
+    frappe.db.sql("""
+        update `tabNetwork Activity Plan`
+        set next_evaluation_at = %(next_evaluation_at)s
+        where name = %(name)s and (next_evaluation_at is null or next_evaluation_at <= %(started)s)
+    """, {"name": name, "started": started, "next_evaluation_at": next_evaluation_at})
+    frappe.db.commit()
+
+
+# Claim a Network Activity for this worker. The conditional UPDATE only matches a Pending activity or one whose lease expired,
+# so of several workers exactly one moves it to Processing, the winner is confirmed by reading the lease owner back.
+# Returns the lease owner, or None when another worker holds the activity.
+def claim(name, ttl=None):
+    owner = f"{socket.gethostname()}:{os.getpid()}:{frappe.generate_hash(length=10)}"
+    now = frappe.utils.now_datetime()
+    expires = now + datetime.timedelta(seconds=int(ttl or utils.conf("activity_lease_ttl", 600)))
+    frappe.db.sql("""
+        update `tabNetwork Activity`
+        set status = 'Processing', lease_owner = %(owner)s, lease_expires = %(expires)s
+        where name = %(name)s
+        and (status = 'Pending' or (status = 'Processing' and lease_expires < %(now)s))
+    """, {"name": name, "owner": owner, "expires": expires, "now": now})
+    frappe.db.commit()
+    if frappe.db.get_value("Network Activity", name, "lease_owner") == owner:
+        return owner
+
+
+# Hand a claimed Network Activity back with `status`, does nothing once the lease was released or taken over
+def release(name, owner, status="Pending"):
+    frappe.db.sql("""
+        update `tabNetwork Activity`
+        set status = %(status)s, lease_owner = null, lease_expires = null
+        where name = %(name)s and status = 'Processing' and lease_owner = %(owner)s
+    """, {"name": name, "owner": owner, "status": status})
+    frappe.db.commit()
+
+
+# Put Network Activities whose worker died while holding the lease back to Pending
+def reclaim():
+    frappe.db.sql(RECLAIM_QUERY, {"now": frappe.utils.now_datetime()})
+    frappe.db.commit()
 
 
 @frappe.whitelist()
@@ -336,25 +466,59 @@ def generate_content(**args):
     name = utils.find(args, "name")
     if not name:
         return
-    doc = frappe.get_doc("Network Activity", name)
-    # Only generate content for Network Activity with status Pending and without content
-    if doc.status != "Pending" or doc.content:
-        return
-    mechanism = frappe.get_doc("Content Mechanism", doc.mechanism)
-    if mechanism.enabled == 0:
-        return
+    # Only one worker generates content for an activity at a time
+    with lock.hold(f"activity:{name}") as acquired:
+        if not acquired:
+            return
+        doc = generate_activity_content(**args)
+    # The cast needs the activity lease, so it is only queued once the lease is released
+    if doc and cast_due(doc):
+        frappe.enqueue("smm.libs.activity.cast", queue="short", job_id=f"smm:cast:{name}", deduplicate=True, name=name)
+    return doc
 
-    # Create filters for Content Generator
-    required_fields = requirements.get(doc.type)
-    filters = {}
-    for field in required_fields:
-        filters[field] = doc.get(field)
 
-    content = openai.generate_content(**filters)
-    if content and content.get("name"):
-        doc.update({"content": content.name}).save()
-        frappe.db.commit()
-        return doc
+# A Pending activity with content whose schedule (or next attempt) has passed, and that the dispatcher doesn't cast on its own.
+# Schedules older than the look-back window are never cast unless retried, like `tasks.activity.cast_query`.
+def cast_due(doc):
+    if dispatcher.enabled():
+        return False
+    due = dispatcher.due_at(doc)
+    now = frappe.utils.now_datetime()
+    return bool(due) and due <= now and frappe.utils.get_datetime(doc.schedule) <= now
+
+
+def generate_activity_content(**args):
+    name = utils.find(args, "name")
+    # Only generate content for Network Activity with status Pending, claimed by this worker
+    owner = claim(name)
+    if not owner:
+        return
+    try:
+        doc = frappe.get_doc("Network Activity", name)
+        if doc.content:
+            return
+        mechanism = frappe.get_doc("Content Mechanism", doc.mechanism)
+        if mechanism.enabled == 0:
+            return
+
+        # Create filters for Content Generator
+        required_fields = requirements.get(doc.type)
+        filters = {}
+        for field in required_fields:
+            filters[field] = doc.get(field)
+
+        content = openai.generate_content(**filters)
+        if content and content.get("name"):
+            # The activity goes back to Pending, ready to be cast
+            doc.flags.activity_lease_held = True
+            doc.update({"content": content.name, "status": "Pending", "lease_owner": None, "lease_expires": None}).save()
+            frappe.db.commit()
+            return doc
+    except Exception:
+        frappe.db.rollback()
+        raise
+    finally:
+        release(name, owner)
 
 
 @frappe.whitelist()
@@ -363,94 +527,204 @@ def cast(**args):
     if not name:
         return
 
-    doc = frappe.get_doc("Network Activity", name)
-    if doc.status != "Pending":
-        return
-
-    agent = frappe.get_doc("Agent", utils.find(args, "agent") or doc.agent)
-    provider = agent.provider
+    agent = utils.find(args, "agent") or frappe.db.get_value("Network Activity", name, "agent")
+    # Only one worker casts an activity, and an agent publishes one post at a time
+    with lock.hold(f"activity:{name}") as activity_acquired:
+        if not activity_acquired:
+            return
+        with lock.hold(f"agent:{agent}") as agent_acquired:
+            if not agent_acquired:
+                # The agent is publishing another post, try again shortly
+                if dispatcher.enabled():
+                    dispatcher.add(name, frappe.utils.now_datetime() + datetime.timedelta(seconds=1))
+                return
+            return cast_activity(**args)
 
-    linked_external_id = None
-    if doc.activity:
-        linked_activity = frappe.get_doc("Network Activity", doc.activity)
-        if linked_activity.external_id:
-            linked_external_id = linked_activity.external_id
 
-    content = utils.find(args, "content") or doc.content
-    content = frappe.get_doc("Content", content) if content else None
-    if not content:
+def cast_activity(**args):
+    name = utils.find(args, "name")
+    # Only cast Network Activity with status Pending, claimed by this worker
+    owner = claim(name)
+    if not owner:
         return
+    sent = False
+    try:
+        doc = frappe.get_doc("Network Activity", name)
+
+        agent = frappe.get_doc("Agent", utils.find(args, "agent") or doc.agent)
+        provider = agent.provider
+
+        linked_external_id = None
+        if doc.activity:
+            linked_activity = frappe.get_doc("Network Activity", doc.activity)
+            if linked_activity.external_id:
+                linked_external_id = linked_activity.external_id
+
+        content = utils.find(args, "content") or doc.content
+        content = frappe.get_doc("Content", content) if content else None
+        if not content:
+            return
 
-    text = utils.remove_quotes(content.description)
+        text = utils.remove_quotes(content.description)
 
-    clients = {
-        "Telegram Bot": telegrambot,
-        "X": x,
-        "Facebook": facebook
-    }
-    client = clients.get(provider)
+        clients = {
+            "Telegram Bot": telegrambot,
+            "X": x,
+            "Facebook": facebook
+        }
+        client = clients.get(provider)
 
-    params = {
-        "name": name,
-        "agent": agent,
-        "text": text,
-        "type": doc.type,
-    }
-    if content.get("image"):
-        items = content.image
-        image_path = (
-            utils.get_absolute_path(random.choice(items).image)
-            if len(items) > 1 and provider != "Telegram Bot"
-            else utils.get_absolute_path(items[0].image)
-        )
-
-        if provider == "Telegram Bot" and len(items) > 1:
-            params.update(
-                {
-                    "media_item_paths": [
-                        utils.get_absolute_path(item.image) for item in items
-                    ]
-                }
+        params = {
+            "name": name,
+            "agent": agent,
+            "text": text,
+            "type": doc.type,
+        }
+        if content.get("image"):
+            items = content.image
+            image_path = (
+                utils.get_absolute_path(random.choice(items).image)
+                if len(items) > 1 and provider != "Telegram Bot"
+                else utils.get_absolute_path(items[0].image)
             )
+
+            if provider == "Telegram Bot" and len(items) > 1:
+                params.update(
+                    {
+                        "media_item_paths": [
+                            utils.get_absolute_path(item.image) for item in items
+                        ]
+                    }
+                )
+            else:
+                params.update({"image_path": image_path})
+
+        if linked_external_id:
+            params.update({"linked_external_id": linked_external_id})
+
+        if not hasattr(client, "send") or not callable(getattr(client, "send")):
+            return
+        # Anything raised while sending may come after the provider accepted the post, except connection errors
+        sent = True
+        try:
+            response = client.send(**params)
+        except Exception as e:
+            if http.connect_error(e):
+                sent = False
+            raise
+
+        # Gateways answer 5xx with HTML or an empty body, keep it as text so the status can still be classified
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"text": response.text}
+        del params["agent"]
+        # Always get nerd statistics.
+        doc.update({
+            "payload": params,
+            "response": data,
+            "response_status": response.status_code,
+        })
+
+        if response.status_code in [200, 201]:
+            # The request is successful, now try to get the external id
+            doc.update({"status": "Success"})
+            if provider == "X":
+                external_id = data.get("data").get("id")
+            elif provider == "Telegram Bot":
+                result = data.get("result")
+                if isinstance(result,list):
+                    external_id = result[0].get("media_group_id")
+                else:
+                    external_id = data.get("result").get("message_id")
+            elif provider == "Facebook":
+                external_id = data.get("id") or data.get("post_id")
+            if external_id:
+                doc.update({"external_id": external_id})
+        elif retryable(response):
+            doc.update(retry(doc, f"HTTP {response.status_code}", response.headers.get("Retry-After")))
         else:
-            params.update({"image_path": image_path})
+            doc.update({"status": "Failed", "last_error": f"HTTP {response.status_code}"})
 
-    if linked_external_id:
-        params.update({"linked_external_id": linked_external_id})
+        doc.update({"lease_owner": None, "lease_expires": None})
+        doc.save()
+        frappe.db.commit()
 
-    if not hasattr(client, "send") or not callable(getattr(client, "send")):
-        return
-    response = client.send(**params)
-
-    # If type of response is dict and has json property
-    data = response.json()
-    del params["agent"]
-    # Always get nerd statistics.
-    doc.update({
-        "payload": params,
-        "response": data,
-        "response_status": response.status_code,
-    })
-
-    if response.status_code in [200, 201]:
-        # The request is successful, now try to get the external id
-        doc.update({"status": "Success"})
-        if provider == "X":
-            external_id = data.get("data").get("id")
-        elif provider == "Telegram Bot":
-            result = data.get("result")
-            if isinstance(result,list):
-                external_id = result[0].get("media_group_id")
-            else:
-                external_id = data.get("result").get("message_id")
-        elif provider == "Facebook":
-            external_id = data.get("id") or data.get("post_id")
-        if external_id:
-            doc.update({"external_id": external_id})
-    else:
-        doc.update({"status": "Failed"})
-
-    doc.save()
-    frappe.db.commit()
+        return response
+    except Exception as e:
+        frappe.db.rollback()
+        # A post that may have been published is never cast again
+        if sent:
+            release(name, owner, "Failed")
+            # Written without doc events, mark the plan like `events.plan_inputs_changed` does
+            mark_plans([frappe.db.get_value("Network Activity", name, "plan")])
+            frappe.db.commit()
+        elif frappe.db.get_value("Network Activity", name, "lease_owner") == owner:
+            doc = frappe.get_doc("Network Activity", name)
+            values = retry(doc, str(e))
+            frappe.db.set_value("Network Activity", name, {**values, "lease_owner": None, "lease_expires": None})
+            if values.get("status") == "Dead":
+                mark_plans([doc.plan])
+            frappe.db.commit()
+            if values.get("next_attempt_at") and dispatcher.enabled():
+                dispatcher.add(name, values.get("next_attempt_at"))
+        raise
+    finally:
+        release(name, owner)
+
+# Responses worth casting again: timeouts, rate limits and server errors
+RETRYABLE_STATUS = [408, 425, 429, 500, 502, 503, 504]
+
+
+def retryable(response):
+    return response.status_code in RETRYABLE_STATUS
+
+
+# Seconds to wait before attempt `attempts`: exponential back-off with jitter, never shorter than the provider's Retry-After
+def backoff(attempts, retry_after=None):
+    delay = min(utils.conf("retry_base_delay", 60) * 2 ** (attempts - 1), utils.conf("retry_max_delay", 3600))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after and str(retry_after).isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
+
+
+# Values that put a Network Activity back in the queue for another attempt, or in the dead letter state (`Dead`)
+# once it ran out of attempts or the next attempt falls after the end of its plan
+def retry(doc, error=None, retry_after=None):
+    attempts = (doc.attempts or 0) + 1
+    next_attempt_at = frappe.utils.now_datetime() + datetime.timedelta(seconds=backoff(attempts, retry_after))
+    plan = frappe.db.get_value("Network Activity Plan", doc.plan, ["end_date", "end_time"], as_dict=True) if doc.plan else None
+    end = utils.comebine_datetime(plan.end_date, plan.end_time, end=True) if plan else None
+    if attempts >= utils.conf("retry_max_attempts", 5) or (end and next_attempt_at > end):
+        frappe.logger("smm").warning(f"Network Activity {doc.name} moved to dead letter after {attempts} attempts: {error}")
+        return {"status": "Dead", "attempts": attempts, "next_attempt_at": None, "last_error": error}
+    return {"status": "Pending", "attempts": attempts, "next_attempt_at": next_attempt_at, "last_error": error}
+
+
+# Retry queue counters for monitoring
+@frappe.whitelist()
+# debug: bench execute smm.libs.activity.retry_stats
+def retry_stats():
+    return {
+        "retrying": frappe.db.count("Network Activity", {"status": "Pending", "attempts": [">", 0]}),
+        "dead": frappe.db.count("Network Activity", {"status": "Dead"}),
+        "failed": frappe.db.count("Network Activity", {"status": "Failed"}),
+    }
+
+
+# Cast the activities ({"name", "agent", ...}) of one agent in the given order, each in its own transaction
+def cast_queue(items):
+    return [pool.run(lambda item: cast(**item), item) for item in items]
+
+
+# Cast engine: agents are cast in parallel on the worker pool while the activities of one agent are cast one after the other,
+# in the given (schedule) order. Every activity is cast in its own transaction, a failed post doesn't stop the agent's next one.
+# Returns one result per activity, see `pool.run`.
+def cast_batch(activities, workers=1):
+    queues = {}
+    for item in activities:
+        queues.setdefault(item.agent, []).append(item)
 
-    return response
+    results = pool.map(cast_queue, list(queues.values()), workers=workers)
+    return [result for queue in results for result in (queue.get("result") or [])]
@@ -0,0 +1,47 @@
+import hashlib
+
+import frappe
+
+
+# Bloom filter stored as a Redis bitmap, shared by every worker of the site.
+# `contains` never misses a value that was added, but may report a value that wasn't (false positive), so callers confirm positives against the database.
+class Bloom:
+    def __init__(self, name, size=2 ** 24, hashes=7):
+        self.name = name
+        self.size = size
+        self.hashes = hashes
+        self.key = frappe.cache().make_key(f"smm:bloom:{name}")
+
+    def positions(self, value):
+        digest = hashlib.sha256(value.encode("utf-8")).digest()
+        # Double hashing: position_i = h1 + i * h2
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, values):
+        values = [value for value in values if value]
+        if not values:
+            return
+        pipeline = frappe.cache().pipeline()
+        for value in values:
+            for position in self.positions(value):
+                pipeline.setbit(self.key, position, 1)
+        pipeline.execute()
+
+    def contains(self, values):
+        values = list(values)
+        if not values:
+            return []
+        pipeline = frappe.cache().pipeline()
+        for value in values:
+            for position in self.positions(value or ""):
+                pipeline.getbit(self.key, position)
+        bits = pipeline.execute()
+        return [all(bits[index * self.hashes:(index + 1) * self.hashes]) for index in range(len(values))]
+
+    def exists(self):
+        return frappe.cache().strlen(self.key) > 0
+
+    def clear(self):
+        frappe.cache().delete_value(f"smm:bloom:{self.name}")
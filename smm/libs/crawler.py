@@ -1,11 +1,19 @@
+import atexit
+import queue
 import re
+import threading
 import time
+from contextlib import contextmanager
 
 import frappe
 from frappe import _
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 from webdriver_manager.chrome import ChromeDriverManager
 
 from . import utils
@@ -16,27 +24,130 @@ def fetch(**args):
     url = utils.find(args, "url")
     img_w = utils.find(args, "img_w", 1024)
     img_h = utils.find(args, "img_h", 768)
-    if not url:
+    # Capture every URL item of the provider in parallel tabs of the same browser
+    urls = utils.find(args, "urls") if utils.find(args, "parallel_tabs") else None
+    readiness = {
+        "readiness": utils.find(args, "readiness"),
+        "selector": utils.find(args, "ready_selector"),
+        "max_wait": utils.find(args, "max_wait"),
+    }
+    if not url and not urls:
         frappe.msgprint(_("{0} URL is empty").format(_("Feed Provider")))
         return
+    urls = urls or [url]
     feeds = []
     try:
-        image = take_screenshot(url, img_w, img_h)
-        feeds.append(
-            {
-                "title": "Screenshot: " + url + " " + frappe.utils.random_string(18),
-                "image": image,
-            }
-        )
+        images = take_screenshots(urls, img_w, img_h, **readiness) if len(urls) > 1 else [take_screenshot(urls[0], img_w, img_h, **readiness)]
+        for url, image in zip(urls, images):
+            feeds.append(
+                {
+                    "title": "Screenshot: " + url + " " + frappe.utils.random_string(18),
+                    "image": image,
+                }
+            )
     except Exception as e:
-        frappe.msgprint(_("Error fetching feeds from {0}").format(url))
+        frappe.msgprint(_("Error fetching feeds from {0}").format(", ".join(urls)))
         raise e
 
     # Must return in this format
-    return {"payload": {"url": url}, "response": None, "feeds": feeds}
+    return {"payload": {"url": url if len(urls) == 1 else urls}, "response": None, "feeds": feeds}
+
+
+def take_screenshot(url, img_w, img_h, readiness=None, selector=None, max_wait=None):
+    with pool().session() as driver:
+        driver.set_window_size(img_w, img_h)
+
+        # Navigate to the URL
+        pool().count(driver)
+        driver.get(url)
+
+        # Wait until the page is ready to be captured
+        wait_ready(driver, readiness, selector, deadline(max_wait))
+        screenshot = driver.get_screenshot_as_png()
+
+    return screenshot
+
+
+def take_screenshots(urls, img_w, img_h, readiness=None, selector=None, max_wait=None):
+    with pool().session() as driver:
+        driver.set_window_size(img_w, img_h)
+        main = driver.current_window_handle
+        until = deadline(max_wait)
+
+        # Start every navigation first so that the pages load at the same time
+        handles = []
+        pool().count(driver, len(urls))
+        for url in urls:
+            driver.switch_to.new_window("tab")
+            handles.append(driver.current_window_handle)
+            driver.execute_script("window.location.href = arguments[0];", url)
+
+        images = []
+        for handle in handles:
+            driver.switch_to.window(handle)
+            # The tab opens on about:blank, which is already complete, wait for the navigation to commit first
+            wait_navigated(driver, until)
+            wait_ready(driver, readiness, selector, until)
+            images.append(driver.get_screenshot_as_png())
+            driver.close()
+        driver.switch_to.window(main)
+
+    return images
+
+
+def deadline(max_wait=None):
+    return time.monotonic() + float(max_wait or 10)
+
+
+# Wait until a navigation started by script has left the blank page of a new tab, or until `until`
+def wait_navigated(driver, until=None):
+    until = until or deadline()
+    try:
+        WebDriverWait(driver, max(until - time.monotonic(), 0.1), poll_frequency=0.1).until(
+            lambda driver: driver.current_url != "about:blank"
+        )
+    except TimeoutException:
+        pass
+
+
+# Wait until the page is ready according to the Feed Provider's readiness strategy, or until `until`.
+# The page is captured as it is when the deadline passes.
+def wait_ready(driver, readiness=None, selector=None, until=None):
+    until = until or deadline()
+    if readiness == "Fixed Delay":
+        time.sleep(max(min(3, until - time.monotonic()), 0))
+        return
+    remaining = max(until - time.monotonic(), 0.1)
+    wait = WebDriverWait(driver, remaining, poll_frequency=0.1)
+    try:
+        if readiness == "Selector" and selector:
+            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
+        elif readiness == "Network Idle":
+            wait.until(NetworkIdle())
+        else:
+            wait.until(lambda driver: driver.execute_script("return document.readyState") == "complete")
+    except TimeoutException:
+        pass
 
 
-def take_screenshot(url, img_w, img_h):
+# The document is loaded and no resource has finished loading for `idle` seconds
+class NetworkIdle:
+    def __init__(self, idle=0.5):
+        self.idle = idle
+        self.count = None
+        self.since = time.monotonic()
+
+    def __call__(self, driver):
+        state, count = driver.execute_script("return [document.readyState, performance.getEntriesByType('resource').length];")
+        now = time.monotonic()
+        if state != "complete" or count != self.count:
+            self.count = count
+            self.since = now
+            return False
+        return now - self.since >= self.idle
+
+
+def new_browser(img_w=1024, img_h=768):
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--no-sandbox")
@@ -46,22 +157,148 @@ def take_screenshot(url, img_w, img_h):
     chrome_options.add_argument(f"--window-size={img_w},{img_h}")
     prefs = {"profile.content_settings.exceptions.clipboard": {"*": {"setting": 1}}}
     chrome_options.add_experimental_option("prefs", prefs)
+    # Return from navigation at DOMContentLoaded, the readiness strategy decides how long to wait after that
+    chrome_options.page_load_strategy = "eager"
 
-    driver = webdriver.Chrome(
-        service=Service(ChromeDriverManager().install()), options=chrome_options
+    return webdriver.Chrome(
+        service=Service(driver_path()), options=chrome_options
     )
 
-    # Navigate to the URL
-    driver.get(url)
 
-    # Wait for a few seconds for the new page to load
-    time.sleep(3)
-    ss_b64 = driver.get_screenshot_as_base64()
+# Resolve the ChromeDriver binary once per process, `install()` may hit the network
+_driver_path = None
+_driver_path_lock = threading.Lock()
 
-    quit_browser(driver)
 
-    return ss_b64
+def driver_path():
+    global _driver_path
+    with _driver_path_lock:
+        if not _driver_path:
+            _driver_path = ChromeDriverManager().install()
+        return _driver_path
 
 
 def quit_browser(driver):
-    driver.quit()
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+
+# Long-lived pool of headless Chrome sessions shared by every Crawler Feed Provider of this process.
+# Sessions are recycled after `max_pages` page loads, or as soon as they fail.
+class BrowserPool:
+    def __init__(self, size=2, max_pages=50, timeout=60):
+        self.size = max(int(size), 1)
+        self.max_pages = max(int(max_pages), 1)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.warmed = False
+
+    def warm(self):
+        if self.warmed:
+            return
+        self.warmed = True
+        # Start every session up front so the first fetches only pay a page navigation
+        drivers = []
+        for _ in range(self.size):
+            if not self.slots.acquire(blocking=False):
+                break
+            try:
+                drivers.append(self.get())
+            except Exception:
+                self.slots.release()
+                raise
+        for driver in drivers:
+            self.release(driver)
+
+    def get(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = new_browser()
+                with self.lock:
+                    self.pages[driver] = 0
+                return driver
+            # Drop sessions whose browser has died while idle
+            try:
+                driver.current_url
+                return driver
+            except Exception:
+                self.discard(driver)
+
+    def release(self, driver, failed=False):
+        with self.lock:
+            pages = self.pages.get(driver, 0)
+        if failed or pages >= self.max_pages:
+            self.discard(driver)
+        else:
+            self.idle.put(driver)
+        self.slots.release()
+
+    # Count page loads of a session, it is recycled once it reaches `max_pages`
+    def count(self, driver, pages=1):
+        with self.lock:
+            if driver in self.pages:
+                self.pages[driver] += pages
+
+    def discard(self, driver):
+        with self.lock:
+            self.pages.pop(driver, None)
+        quit_browser(driver)
+
+    @contextmanager
+    def session(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError("No browser session available")
+        try:
+            driver = self.get()
+        except Exception:
+            self.slots.release()
+            raise
+        failed = False
+        try:
+            yield driver
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if not failed:
+                # Don't leak state between Feed Providers, cookies of every domain are cleared
+                try:
+                    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+                    driver.get("about:blank")
+                except Exception:
+                    failed = True
+            self.release(driver, failed=failed)
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(size=utils.conf("crawler_pool_size", 2), max_pages=utils.conf("crawler_max_pages", 50))
+            atexit.register(_pool.close)
+        return _pool
+
+
+# Called before every background job, starts the browser pool when `smm_crawler_warm` is enabled
+def warm(**args):
+    if not utils.conf("crawler_warm"):
+        return
+    pool().warm()
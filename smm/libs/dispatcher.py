@@ -0,0 +1,180 @@
+import datetime
+import time
+
+import frappe
+
+from . import utils
+
+# Redis sorted set of Network Activity name -> due timestamp, shared by every worker of the site
+KEY = "smm:dispatch"
+
+# Activities scheduled longer ago than this are never cast, unless they are retried, like `tasks.activity.cast_query`
+LOOK_BACK = datetime.timedelta(hours=1)
+
+
+# Time wheel of the Network Activities waiting to be cast.
+# The sorted set is kept up to date by doc events (see `sync`) and rebuilt from the database by `load`, `run` sleeps until the
+# earliest activity is due and hands every due activity to a background job, so posts go out at their schedule instead of the
+# next scheduler tick and nothing queries the database while nothing is due.
+def enabled():
+    return bool(utils.conf("dispatcher"))
+
+
+def key():
+    return frappe.cache().make_key(KEY)
+
+
+# Activities that wait to be cast: Pending, enabled, with content, scheduled within `LOOK_BACK`. A retry is due at its next attempt.
+def due_at(doc):
+    if not doc.get("enabled") or doc.get("status") != "Pending" or not doc.get("content") or not doc.get("schedule"):
+        return None
+    if doc.get("next_attempt_at"):
+        return frappe.utils.get_datetime(doc.get("next_attempt_at"))
+    schedule = frappe.utils.get_datetime(doc.get("schedule"))
+    if schedule < frappe.utils.now_datetime() - LOOK_BACK:
+        return None
+    return schedule
+
+
+# Scores are timestamps of naive datetimes in the system time zone, compare them with `now` only
+def now():
+    return frappe.utils.now_datetime().timestamp()
+
+
+def add(name, when):
+    frappe.cache().zadd(key(), {name: when.timestamp()})
+
+
+def discard(name):
+    frappe.cache().zrem(key(), name)
+
+
+# doc_events handler of Network Activity, the set is changed after the transaction commits
+def sync(doc, method=None):
+    if not enabled():
+        return
+    name = doc.name
+    when = due_at(doc) if method != "on_trash" else None
+
+    def update():
+        if when:
+            add(name, when)
+        else:
+            discard(name)
+
+    frappe.db.after_commit.add(update)
+
+
+# Rebuild the set from the database, catching up with changes made without doc events (e.g. reclaimed leases)
+def load():
+    client = frappe.cache()
+    # Start a new transaction, the long running loop would read an old snapshot otherwise
+    frappe.db.commit()
+    activities = frappe.get_all(
+        "Network Activity",
+        filters=[
+            ["enabled", "=", True],
+            ["status", "=", "Pending"],
+            ["content", "is", "set"],
+            ["schedule", "is", "set"]
+        ],
+        or_filters=[
+            ["schedule", ">=", frappe.utils.now_datetime() - LOOK_BACK],
+            ["next_attempt_at", "is", "set"]
+        ],
+        fields=["name", "enabled", "status", "content", "schedule", "next_attempt_at"]
+    )
+    pipeline = client.pipeline()
+    pipeline.delete(key())
+    for activity in activities:
+        when = due_at(activity)
+        if when:
+            pipeline.zadd(key(), {activity.name: when.timestamp()})
+    pipeline.execute()
+    return len(activities)
+
+
+# Take the activities due until now off the set. ZREM only succeeds for one caller, so concurrent dispatchers never share an activity.
+def pop_due():
+    client = frappe.cache()
+    names = client.zrangebyscore(key(), "-inf", now())
+    popped = []
+    for name in names:
+        name = frappe.safe_decode(name)
+        if client.zrem(key(), name):
+            popped.append(name)
+    return popped
+
+
+# Seconds until the earliest activity is due, None when the set is empty
+def wait_time():
+    earliest = frappe.cache().zrange(key(), 0, 0, withscores=True)
+    if not earliest:
+        return None
+    return max(earliest[0][1] - now(), 0)
+
+
+# Cast the popped activities in background jobs, one job per agent keeps the posts of an agent in schedule order
+def dispatch(names):
+    if not names:
+        return
+    activities = frappe.get_all(
+        "Network Activity",
+        filters={"name": ["in", names]},
+        fields=["name", "agent", "schedule"],
+        order_by="schedule asc"
+    )
+    queues = {}
+    for activity in activities:
+        queues.setdefault(activity.agent, []).append({"name": activity.name, "agent": activity.agent})
+    for queue in queues.values():
+        frappe.enqueue("smm.libs.activity.cast_queue", queue="short", items=queue)
+    frappe.db.commit()
+
+
+# Long running dispatcher loop, run it next to the workers (e.g. a supervisor program or Procfile entry):
+# bench --site [site] execute smm.libs.dispatcher.run
+# `duration` stops the loop after that many seconds, the default runs forever.
+def run(duration=None):
+    started = time.monotonic()
+    poll = float(utils.conf("dispatcher_poll", 1))
+    reload = float(utils.conf("dispatcher_reload", 300))
+    logger = frappe.logger("smm")
+    loaded = None
+    while duration is None or time.monotonic() - started < float(duration):
+        names = []
+        try:
+            if loaded is None or time.monotonic() - loaded >= reload:
+                logger.info(f"Dispatcher loaded {load()} Network Activities")
+                loaded = time.monotonic()
+            wait = wait_time()
+            # Wake up at the earliest schedule, or after `poll` seconds to pick up activities added meanwhile
+            if wait is None or wait > 0:
+                time.sleep(min(wait if wait is not None else poll, poll))
+                continue
+            names = pop_due()
+            dispatch(names)
+            logger.info(f"Dispatched {len(names)} Network Activities")
+        except Exception:
+            # A failing Redis or database call must not stop casting, log it and try again on the next iteration
+            logger.exception("Dispatcher iteration failed")
+            try:
+                frappe.db.rollback()
+            except Exception:
+                # The connection itself is gone, open a new one
+                try:
+                    frappe.db.connect()
+                except Exception:
+                    pass
+            if names:
+                restore(names)
+            time.sleep(poll)
+
+
+# Put popped activities back when they could not be dispatched, they are due right away
+def restore(names):
+    try:
+        frappe.cache().zadd(key(), {name: now() for name in names})
+    except Exception:
+        # Redis is unavailable, the next `load` queues them again
+        frappe.logger("smm").exception("Dispatcher could not restore popped Network Activities")
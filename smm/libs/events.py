@@ -0,0 +1,77 @@
+import datetime
+
+import frappe
+
+from . import activity
+
+# Network Activities get their content this long before their schedule, like `tasks.activity.process_activities`
+LOOK_AHEAD = datetime.timedelta(hours=1)
+
+
+# Run the downstream step of a document change in the background as soon as the change is committed,
+# instead of waiting for the next scheduler tick. The job id deduplicates bursts of changes to the same document.
+def enqueue(method, job_id, **kwargs):
+    frappe.enqueue(method, queue="short", job_id=job_id, deduplicate=True, enqueue_after_commit=True, **kwargs)
+
+
+# doc_events handler of Network Activity Plan: schedule an enabled plan right away
+def plan_changed(doc, method=None):
+    if not doc.enabled:
+        return
+    enqueue("smm.libs.activity.generate_activity", f"smm:plan:{doc.name}", name=doc.name)
+
+
+# doc_events handler of Network Activity: generate the content of an activity that is about to be due,
+# and cast an activity that got its content after its schedule
+def activity_changed(doc, method=None):
+    if not doc.enabled or doc.status != "Pending" or not doc.schedule:
+        return
+    now = frappe.utils.now_datetime()
+    schedule = frappe.utils.get_datetime(doc.schedule)
+    if not doc.content:
+        if schedule <= now + LOOK_AHEAD:
+            enqueue("smm.libs.activity.generate_content", f"smm:content:{doc.name}", name=doc.name)
+        return
+    # `activity.generate_content` queues the cast itself once it released the activity lease
+    if doc.flags.activity_lease_held:
+        return
+    if activity.cast_due(doc):
+        enqueue("smm.libs.activity.cast", f"smm:cast:{doc.name}", name=doc.name)
+
+
+# New Feeds may be what Network Activities without content are waiting for. Feeds are bulk inserted, so `feed.ingest`
+# calls this directly, the hook covers Feeds inserted one by one.
+def feeds_added(doc=None, method=None):
+    enqueue("smm.tasks.activity.process_activities", "smm:process_activities")
+
+
+# doc_events handler of the inputs of Network Activity Plans: mark the plans that depend on the changed document
+def plan_inputs_changed(doc, method=None):
+    plans = []
+    if doc.doctype == "Network Activity":
+        # A completed activity frees its slot, and may be a candidate of plans replying to or sharing its plan
+        if method != "on_trash" and (doc.status not in ["Success", "Failed", "Dead"] or not doc.has_value_changed("status")):
+            return
+        plans.append(doc.plan)
+        plans += linked_plans("Network Activity Plan Item", "plan", doc.plan)
+        plans += linked_plans("Network Activity Item", "activity", doc.name)
+    elif doc.doctype == "Agent":
+        # Token refreshes and profile updates save the Agent on every tick, only its provider and groups are plan inputs
+        groups = set(item.agent_group for item in doc.get("agent_groups") or [])
+        before = doc.get_doc_before_save()
+        before_groups = set(item.agent_group for item in before.get("agent_groups") or []) if before else set()
+        if before and before.provider == doc.provider and before_groups == groups:
+            return
+        plans += linked_plans("Agent Item", "agent", doc.name)
+        # Plans of groups the agent left lose it, plans of groups it joined gain it
+        for agent_group in groups | before_groups:
+            plans += linked_plans("Agent Group Item", "agent_group", agent_group)
+    elif doc.doctype == "Content Mechanism":
+        plans += linked_plans("Content Mechanism Item", "content_mechanism", doc.name)
+    activity.mark_plans(plans)
+
+
+def linked_plans(child_doctype, field, value):
+    if not value:
+        return []
+    return frappe.get_all(child_doctype, filters={"parenttype": "Network Activity Plan", field: value}, pluck="parent")
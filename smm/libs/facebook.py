@@ -1,13 +1,12 @@
 import frappe
 from frappe import _
-import requests
 import json
 import base64
 import hashlib
 import re
 import os
 from urllib.parse import urlencode
-from . import utils
+from . import http, utils
 
 # Facebook Graph API integration for posting content
 # Docs: https://developers.facebook.com/docs/graph-api/
@@ -81,7 +80,7 @@ class Facebook:
         if method == "GET" and not request:
             return url + "?" + urlencode(params)
         if request:
-            return requests.request(method, url, params=params, json=json, headers=headers)
+            return http.request(method, url, params=params, json=json, headers=headers)
 
     # Returns authorization URL, state, code_verifier, code_challenge, code_challenge_method
     def authorize(self, redirect_uri=None, scope=[], state=None, code_verifier=None, code_challenge=None, code_challenge_method="S256"):
@@ -391,7 +390,7 @@ def upload_photo(client, image_path, caption="", agent=None):
                 files = {'source': image_file}
                 params = {'message': caption}
                 
-                response = requests.post(
+                response = http.post(
                     endpoint,
                     files=files,
                     data=params,
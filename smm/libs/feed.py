@@ -1,11 +1,12 @@
 import base64
+import datetime
 import json
 import random
 
 import frappe
 from frappe import _
 
-from . import crawler, facebook, openai, rss, telegrambot, utils, x
+from . import bloom, crawler, events, facebook, lock, openai, pool, rss, storage, telegrambot, utils, x
 
 clients = {
     "OpenAI": openai,
@@ -19,6 +20,15 @@ feed_provider_locale = _("Feed Provider")
 @frappe.whitelist()
 # debug: bench execute smm.libs.feed.fetch --kwargs '{"name":"6868b18b03"}'
 def fetch(**args):
+    name = utils.find(args, "name")
+    # Only one worker fetches a provider at a time
+    with lock.hold(f"feed_provider:{name}") as acquired:
+        if not acquired:
+            return
+        return fetch_provider(**args)
+
+
+def fetch_provider(**args):
     name = utils.find(args, "name")
     method = "fetch"
 
@@ -46,14 +56,57 @@ def fetch(**args):
     if not client or not hasattr(client, method) or not callable(getattr(client, method)):
         return
     
+    new_feeds = []
+    new_items = 0
+
     # Must returns {payload, response, feeds}
     payload = doc.as_dict()
-    url_item = random.choice(doc.url)
-    payload["url"] = url_item.url
-    process = getattr(client, method)(**payload)
-    if process:
+    payload["urls"] = [item.url for item in doc.url]
+    if doc.fetch_all_urls and doc.type == "RSS":
+        # Fetch every URL at once, the whole fetch costs about as much as the slowest URL
+        url_items = list(doc.url)
+    else:
+        # Use the given URL if it belongs to this provider, otherwise pick one randomly
+        url = utils.find(args, "url")
+        url_item = next((item for item in doc.url if item.url == url), None) if url else None
+        url_items = [url_item or random.choice(doc.url)]
+
+    def fetch_url(url_item):
+        # Validators for conditional requests
+        # Virtual providers keep the whole document in `feeds`, so they always parse every item
+        return getattr(client, method)(**{
+            **payload,
+            "url": url_item.url,
+            "etag": url_item.etag,
+            "last_modified": url_item.last_modified,
+            "content_hash": url_item.content_hash,
+            "last_item": url_item.last_item if not doc.virtual else None
+        })
+
+    if len(url_items) > 1:
+        processes = [result.get("result") for result in pool.map(fetch_url, url_items, workers=utils.conf("fetch_url_workers", 4))]
+    else:
+        processes = [fetch_url(url_items[0])]
+
+    # Merge items of every URL, the first occurrence of an item wins
+    feeds = []
+    seen = set()
+    for url_item, process in zip(url_items, processes):
+        record(url_item, process)
+        if not process or (process.get("cache") or {}).get("unchanged"):
+            continue
+        for feed in process.get("feeds") or []:
+            key = utils.fingerprint(feed.get("url"), feed.get("title"))
+            if key not in seen:
+                seen.add(key)
+                feeds.append(feed)
+
+    if len(url_items) == 1 and processes[0]:
+        process = processes[0]
         if process.get("payload") and process.get("response"):
             response = process.get("response")
+            # Streamed responses hand over the bytes that were actually read
+            content = process.get("content") if process.get("content") is not None else response.content
             request = response.request
             payload = {
                 "url": request.url,
@@ -63,46 +116,206 @@ def fetch(**args):
             }
             doc.update({
                 "payload": payload,
-                "response": json.dumps({"content": response.content.decode("utf-8")}),
+                "response": json.dumps({"content": content.decode("utf-8", errors="replace")}),
                 "response_status": response.status_code
             })
-        if process.get("feeds") is not None and len(process.get("feeds")) > 0:
-            doc.update({"feeds": json.dumps(process.get("feeds"), indent=4)})
-            if not doc.virtual:
-                for feed in process.get("feeds"):
-                    file_data = base64.b64decode(feed.pop("image"))
-                    # Check if the feed already exists before inserting
-                    if not frappe.db.exists({"doctype":"Feed", **feed}):
-                        new_doc = frappe.get_doc({
-                            "owner": owner,
-                            "doctype": "Feed",
-                            "provider": name,
-                            **feed
-                        }).insert()
-                        frappe.db.commit()
-                        save_image(file_data, new_doc)
-    # Update fetched datetime
+    elif len(url_items) > 1:
+        doc.update({
+            "payload": {"urls": [item.url for item in url_items]},
+            "response": json.dumps({"urls": [{"url": item.url, "status": item.status, "response_status": item.response_status} for item in url_items]}),
+            "response_status": max([item.response_status or 0 for item in url_items])
+        })
+
+    # Skip upserts when the documents haven't changed since the previous fetch
+    if len(feeds) > 0:
+        # Keep images out of the `feeds` JSON, it only holds references to them
+        if doc.virtual:
+            store_images(feeds, name, format=doc.image_format, quality=doc.image_quality, max_width=doc.image_max_width)
+            new_items = len(feeds)
+        else:
+            new_feeds = ingest(feeds, provider=name, owner=owner)
+            new_items = len(new_feeds)
+        doc.update({"feeds": json.dumps(feeds, indent=4)})
+    # Update fetched datetime and plan the next fetch
     doc.update({"fetched": frappe.utils.now()})
+    schedule(doc, new_items=new_items, failed=not any(processes))
     doc.save()
+    # New Feeds and the provider update land in a single transaction
     frappe.db.commit()
+    # Attach images as a follow-up step, outside of the ingest transaction
+    attach_images(new_feeds, format=doc.image_format, quality=doc.image_quality, max_width=doc.image_max_width)
     return True
 
 
-def save_image(content, doc):
-    # Convert file content to PNG using PIL and io
-    content = utils.to_png(content)
-    random_name = frappe.utils.random_string(24) + ".png"
-    utils.check_folder(name="SMM")
-    file = frappe.utils.file_manager.save_file(
-        random_name,
-        content,
-        dt="Feed",
-        dn=doc.name,
-        df="image",
-        folder="Home/SMM",
-        decode=False,
-        is_private=False,
-    )
-    doc.update({"image": file.get("file_url")})
-    doc.save()
+# Store validators and the status of one URL item after it was fetched
+def record(url_item, process):
+    cache = (process or {}).get("cache")
+    response = (process or {}).get("response")
+    if cache:
+        url_item.update({
+            "etag": cache.get("etag"),
+            "last_modified": cache.get("last_modified"),
+            "content_hash": cache.get("content_hash"),
+            "last_item": cache.get("last_item")
+        })
+    url_item.update({
+        "status": "Failed" if not process else "Not Modified" if (cache or {}).get("unchanged") else "Success",
+        "response_status": response.status_code if response is not None else None,
+        "fetched": frappe.utils.now()
+    })
+
+
+# Adapt the interval of a Feed Provider to how often it really changes and set `next_fetch_at`.
+# Fetches with new items halve the interval and empty ones stretch it by half, within Minimum Duration and Maximum Duration.
+# Failing providers back off exponentially and are quarantined after `smm_fetch_quarantine_after` failures in a row.
+def schedule(doc, new_items=0, failed=False):
+    now = frappe.utils.now_datetime()
+    duration = doc.duration or 0
+    low = doc.min_duration or duration
+    high = max(doc.max_duration or duration, low)
+    interval = doc.effective_duration or duration
+
+    if failed:
+        failures = (doc.failures or 0) + 1
+        delay = min(max(interval, 60) * 2 ** failures, utils.conf("fetch_max_backoff", 86400))
+        quarantined_until = None
+        if failures >= utils.conf("fetch_quarantine_after", 5):
+            quarantined_until = now + datetime.timedelta(seconds=utils.conf("fetch_quarantine", 86400))
+        doc.update({
+            "failures": failures,
+            "quarantined_until": quarantined_until,
+            "next_fetch_at": quarantined_until or now + datetime.timedelta(seconds=delay)
+        })
+        return
+
+    interval = interval / 2 if new_items > 0 else interval * 1.5
+    interval = min(max(interval, low), high)
+    doc.update({
+        "failures": 0,
+        "quarantined_until": None,
+        "effective_duration": interval,
+        "next_fetch_at": now + datetime.timedelta(seconds=interval)
+    })
+
+
+# Record a fetch that raised an error
+def failed(name):
+    doc = frappe.get_doc("Feed Provider", name)
+    schedule(doc, failed=True)
+    doc.db_update()
+    frappe.db.commit()
+
+
+# Write all new Feeds of one provider fetch with a single bulk insert. Doesn't commit.
+# Returns [{"name", "fingerprint", "image"}] of the Feeds that were actually inserted.
+def ingest(feeds, provider=None, owner=None):
+    for feed in feeds:
+        feed["fingerprint"] = utils.fingerprint(feed.get("url"), feed.get("title"))
+    # Resolve all items of this fetch to new vs known at once
+    known = known_fingerprints([feed.get("fingerprint") for feed in feeds])
+
+    now = frappe.utils.now()
+    owner = owner or frappe.session.user
+    fields = ["name", "owner", "creation", "modified", "modified_by", "docstatus", "provider", "title", "description", "url", "fingerprint"]
+    values = []
+    new_feeds = []
+    for feed in feeds:
+        image = feed.pop("image", None)
+        if feed.get("fingerprint") in known:
+            continue
+        known.add(feed.get("fingerprint"))
+        feed_name = frappe.generate_hash(length=10)
+        values.append((feed_name, owner, now, now, owner, 0, provider, feed.get("title"), feed.get("description"), feed.get("url"), feed.get("fingerprint")))
+        new_feeds.append({"name": feed_name, "fingerprint": feed.get("fingerprint"), "image": image})
+
+    if not values:
+        return []
+
+    # Rows inserted by another worker in the meantime are skipped by the unique fingerprint index
+    frappe.db.bulk_insert("Feed", fields, values, ignore_duplicates=True)
+    inserted = set(frappe.get_all("Feed", filters={"name": ["in", [feed.get("name") for feed in new_feeds]]}, pluck="name"))
+    new_feeds = [feed for feed in new_feeds if feed.get("name") in inserted]
+    remember_fingerprints([feed.get("fingerprint") for feed in new_feeds])
+    if new_feeds:
+        events.feeds_added()
+    # Reference the new Feed documents, which hold the images
+    names = {feed.get("fingerprint"): feed.get("name") for feed in new_feeds}
+    for feed in feeds:
+        if names.get(feed.get("fingerprint")):
+            feed["feed"] = names.get(feed.get("fingerprint"))
+    return new_feeds
+
+
+def attach_images(feeds, **options):
+    feeds = [feed for feed in feeds or [] if feed.get("image")]
+    if not feeds:
+        return
+    for feed in feeds:
+        image = feed.get("image")
+        save_image(image if isinstance(image, bytes) else base64.b64decode(image), feed.get("name"), **options)
     frappe.db.commit()
+
+
+# Store images of a virtual provider's feeds as files attached to the Feed Provider and replace them by their URL.
+# Files no longer referenced by the latest feeds are released.
+def store_images(feeds, name, **options):
+    urls = []
+    for feed in feeds:
+        image = feed.get("image")
+        if not image or (isinstance(image, str) and image.startswith("/")):
+            continue
+        content = image if isinstance(image, bytes) else base64.b64decode(image)
+        feed["image"] = save_blob(content, name, **options)
+        urls.append(feed.get("image"))
+
+    storage.release("Feed Provider", name, df="feeds", keep=urls or [""])
+
+
+def save_blob(content, name, **options):
+    return storage.save(content, dt="Feed Provider", dn=name, df="feeds", **options)
+
+
+# Bloom filter of every Feed fingerprint, warmed from the database the first time it is used
+def fingerprints():
+    fingerprint_filter = bloom.Bloom("feed_fingerprint")
+    if not fingerprint_filter.exists():
+        page_length = 10000
+        start = 0
+        while True:
+            items = frappe.get_all("Feed", filters={"fingerprint": ["is", "set"]}, pluck="fingerprint", order_by="name asc", limit_start=start, limit_page_length=page_length)
+            fingerprint_filter.add(items)
+            if len(items) < page_length:
+                break
+            start += page_length
+        # Make sure the bitmap exists even when there is no Feed yet
+        fingerprint_filter.add(["smm"])
+    return fingerprint_filter
+
+
+# Return the set of given fingerprints that already exist as Feeds, using one query for all of them.
+# Fingerprints the Bloom filter has never seen are new for sure and don't reach the database.
+def known_fingerprints(items):
+    items = list({item for item in items if item})
+    if not items:
+        return set()
+    try:
+        candidates = [item for item, maybe in zip(items, fingerprints().contains(items)) if maybe]
+    except Exception:
+        # Redis is unavailable, let the database decide
+        candidates = items
+    if not candidates:
+        return set()
+    return set(frappe.get_all("Feed", filters={"fingerprint": ["in", candidates]}, pluck="fingerprint"))
+
+
+def remember_fingerprints(items):
+    try:
+        fingerprints().add(items)
+    except Exception:
+        # The filter is rebuilt from the database once Redis is back
+        pass
+
+
+def save_image(content, name, **options):
+    file_url = storage.save(content, dt="Feed", dn=name, df="image", **options)
+    frappe.db.set_value("Feed", name, "image", file_url)
@@ -0,0 +1,88 @@
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import utils
+
+# One pooled session per scheme and host, shared by every client of this process
+_sessions = {}
+_lock = threading.Lock()
+
+
+def session(url):
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = new_session()
+        return _sessions[key]
+
+
+# Retry-After is honoured up to `smm_http_retry_after_max` seconds. A host asking for longer waits is left to the
+# Feed Provider back-off instead of blocking the worker (and the leases it holds) for that long.
+class CappedRetry(Retry):
+    def get_retry_after(self, response):
+        seconds = super().get_retry_after(response)
+        if seconds is None:
+            return None
+        return min(seconds, float(utils.conf("http_retry_after_max", 30)))
+
+
+def new_session():
+    client = requests.Session()
+    # Sessions are shared between agents, never carry cookies from one request to another
+    client.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    # Only idempotent requests are retried, a retried POST could publish the same post twice
+    retries = CappedRetry(
+        total=utils.conf("http_retries", 3),
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["HEAD", "GET", "OPTIONS"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=utils.conf("http_pool_size", 10), max_retries=retries)
+    client.mount("http://", adapter)
+    client.mount("https://", adapter)
+    return client
+
+
+# Drop inherited sessions in forked workers, their sockets belong to the parent process
+def reset():
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
+
+
+def request(method, url, **args):
+    if args.get("timeout") is None:
+        args["timeout"] = utils.conf("http_timeout", 120)
+    return session(url).request(method, url, **args)
+
+
+def get(url, **args):
+    return request("GET", url, **args)
+
+
+def post(url, **args):
+    return request("POST", url, **args)
+
+
+# True when `error` was raised while connecting, before any byte of the request was sent
+def connect_error(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
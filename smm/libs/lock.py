@@ -0,0 +1,74 @@
+import functools
+import threading
+from contextlib import contextmanager
+
+import frappe
+
+from . import utils
+
+RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+EXTEND = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+
+
+# Redis lease held by one worker at a time across every process of the site.
+# The lease expires after `ttl` seconds unless it is extended, a heartbeat thread extends it while the holder is alive,
+# so a crashed worker never blocks the work for longer than `ttl`.
+class Lease:
+    def __init__(self, name, ttl=None, heartbeat=True):
+        self.name = name
+        self.ttl = int(ttl or utils.conf("lock_ttl", 300))
+        self.heartbeat = heartbeat
+        self.client = frappe.cache()
+        self.key = self.client.make_key(f"smm:lock:{name}")
+        self.token = frappe.generate_hash(length=20)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def acquire(self):
+        if not self.client.set(self.key, self.token, nx=True, ex=self.ttl):
+            return False
+        if self.heartbeat:
+            self.thread = threading.Thread(target=self.beat, name=f"smm-lock-{self.name}", daemon=True)
+            self.thread.start()
+        return True
+
+    def beat(self):
+        while not self.stopped.wait(max(self.ttl / 3, 1)):
+            try:
+                if not self.extend():
+                    break
+            except Exception:
+                pass
+
+    def extend(self):
+        return bool(self.client.eval(EXTEND, 1, self.key, self.token, self.ttl))
+
+    def release(self):
+        self.stopped.set()
+        self.client.eval(RELEASE, 1, self.key, self.token)
+
+
+# Hold the lease `name` for the duration of the block, yields False when another worker holds it
+@contextmanager
+def hold(name, ttl=None):
+    lease = Lease(name, ttl)
+    acquired = lease.acquire()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            lease.release()
+
+
+# Skip a call while another call of the same task is still running on any worker
+def single_flight(name=None, ttl=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with hold(f"task:{name or function.__module__ + '.' + function.__name__}", ttl) as acquired:
+                if not acquired:
+                    frappe.logger("smm").info(f"Skipped {function.__name__}, the previous run is still in progress")
+                    return
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -5,10 +5,9 @@ from typing import List, Union
 
 import frappe
 import PIL
-import requests
 from frappe import _
 
-from ..libs import utils
+from ..libs import http, storage, utils
 
 
 class OpenAI:
@@ -51,7 +50,7 @@ class OpenAI:
             data = JSON.dumps(data)
             json = JSON.dumps(json)
         
-        return requests.request( method, url, headers=headers, data=data, json=json, **args)
+        return http.request(method, url, headers=headers, data=data, json=json, **args)
 
 def join_data(args):
     title = utils.find(args, "title")
@@ -107,7 +106,7 @@ def generate_content(**args):
         feed_provider = frappe.get_doc("Feed Provider", item.feed_provider)
         # If feed provider is virtual, try to get feeds from the `feeds` field, which is a JSON array, then append to `feeds` list.
         # Else get feeds from the database.
-        docs = JSON.loads(feed_provider.feeds) if feed_provider.feeds and feed_provider.virtual else frappe.db.get_list("Feed", filters={"provider": item.feed_provider}, fields=["name", "title", "description", "image"], order_by="creation desc", limit_start=0, limit_page_length=item.limit)
+        docs = [frappe._dict(feed) for feed in JSON.loads(feed_provider.feeds)] if feed_provider.feeds and feed_provider.virtual else frappe.db.get_list("Feed", filters={"provider": item.feed_provider}, fields=["name", "title", "description", "image"], order_by="creation desc", limit_start=0, limit_page_length=item.limit)
         if len(docs) > item.limit: docs = random.sample(docs, item.limit)
 
         for doc in docs:
@@ -150,18 +149,15 @@ def generate_content(**args):
         if isinstance(urls, str):
             urls = urls.split(",")
         image_items = []
-        check_folder(name="SMM")
         for url in urls:
-            file = requests.get(url=url)
-            # Convert file content to PNG using PIL and io
-            content = to_png(file.content)
-            random_name = frappe.utils.random_string(24) + ".png"
+            file = http.get(url)
             if not new_doc.name:
                 new_doc.insert()
                 frappe.db.commit()
 
-            file = frappe.utils.file_manager.save_file(random_name, content, dt="Content", dn=new_doc.name, df="image", folder="Home/SMM", decode=False, is_private=False)
-            image_items.append({"image":file.get("file_url")})
+            # The same bytes already stored for a Feed or another Content are reused instead of stored again
+            file_url = storage.save(file.content, dt="Content", dn=new_doc.name, df="image")
+            image_items.append({"image": file_url})
         new_doc.update({
             "image": image_items
         })
@@ -0,0 +1,68 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+
+
+# Run `callback(item)` for every item on a bounded thread pool.
+# Each worker thread opens its own Frappe context and database connection, so network I/O overlaps while DB writes never share a connection.
+# `key(item)` groups items (e.g. by host) and `limit` caps how many items of the same group run at the same time.
+# Returns one dict per item: {"item", "result", "error", "elapsed"} in the same order as `items`.
+def map(callback, items, workers=1, key=None, limit=None):
+    items = list(items)
+    workers = max(int(workers or 1), 1)
+
+    # Nothing to overlap, run in the current context like before
+    if workers == 1 or len(items) <= 1:
+        return [run(callback, item) for item in items]
+
+    site = frappe.local.site
+    sites_path = frappe.local.sites_path
+    user = frappe.session.user if getattr(frappe.local, "session", None) else "Administrator"
+
+    semaphores = {}
+    guard = threading.Lock()
+
+    def semaphore(item):
+        if not key or not limit:
+            return None
+        group = key(item)
+        with guard:
+            if group not in semaphores:
+                semaphores[group] = threading.BoundedSemaphore(int(limit))
+            return semaphores[group]
+
+    def task(item):
+        lock = semaphore(item)
+        if lock:
+            lock.acquire()
+        try:
+            frappe.init(site=site, sites_path=sites_path)
+            frappe.connect()
+            frappe.set_user(user)
+            try:
+                return run(callback, item)
+            finally:
+                frappe.destroy()
+        finally:
+            if lock:
+                lock.release()
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix="smm") as executor:
+        return list(executor.map(task, items))
+
+
+# Run a single item in the current Frappe context, committing on success and rolling back on error.
+def run(callback, item):
+    started = time.monotonic()
+    result = error = None
+    try:
+        result = callback(item)
+        frappe.db.commit()
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(title="SMM worker failed", message=frappe.get_traceback())
+        frappe.db.commit()
+        error = e
+    return {"item": item, "result": result, "error": error, "elapsed": time.monotonic() - started}
@@ -1,11 +1,15 @@
 import frappe
 from frappe import _
-import requests
+import datetime
+import hashlib
 import re
 import html
 import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse, parse_qs
-from . import utils
+from . import http, utils
+
+ATOM = "{http://www.w3.org/2005/Atom}"
 
 @frappe.whitelist()
 def fetch(**args):
@@ -14,23 +18,83 @@ def fetch(**args):
         frappe.msgprint(_("{0} URL is empty").format(_("Feed Provider")))
         return
     feeds = []
-    response = requests.get(url, headers={"Cache-Control": "no-cache"}, timeout=10)
+    # Validators from the previous fetch of this URL
+    etag = utils.find(args, "etag")
+    last_modified = utils.find(args, "last_modified")
+    content_hash = utils.find(args, "content_hash")
+    # The first item of the previous fetch, parsing stops once it is reached in a newest-first feed
+    last_item = utils.find(args, "last_item")
+    headers = {"Cache-Control": "no-cache"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = http.get(url, headers=headers, timeout=10, stream=True)
+    cache = {
+        "etag": response.headers.get("ETag") or etag,
+        "last_modified": response.headers.get("Last-Modified") or last_modified,
+        "content_hash": content_hash,
+        "last_item": last_item,
+        "unchanged": False
+    }
+    # Nothing changed since the previous fetch, skip parsing
+    if response.status_code == 304:
+        response.close()
+        cache["unchanged"] = True
+        return {"payload": {"url": url}, "response": response, "content": b"", "feeds": None, "cache": cache}
     if response.status_code != 200:
+        response.close()
         frappe.msgprint(_("Error fetching feeds from {0}").format(url))
         return
     elif response.status_code == 200:
-        rss = parse(response.content.decode('utf-8'))
-        if not rss:
+        hasher = hashlib.sha256()
+        chunks = []
+        if content_hash:
+            # Compare the whole body with the previous fetch before parsing anything
+            for chunk in response.iter_content(chunk_size=16384):
+                hasher.update(chunk)
+                chunks.append(chunk)
+            response.close()
+            content = b"".join(chunks)
+            cache["content_hash"] = hasher.hexdigest()
+            # The server doesn't support validators but the body is identical, skip parsing and upserts
+            if cache["content_hash"] == content_hash:
+                cache["unchanged"] = True
+                return {"payload": {"url": url}, "response": response, "content": content, "feeds": None, "cache": cache}
+            rss = parse_stream(iter(chunks), stop_at=last_item)
+        else:
+            # Hash and parse the body chunk by chunk
+            def read():
+                for chunk in response.iter_content(chunk_size=16384):
+                    hasher.update(chunk)
+                    chunks.append(chunk)
+                    yield chunk
+            rss = parse_stream(read(), stop_at=last_item)
+            response.close()
+            content = b"".join(chunks)
+            # The hash is only known once the whole body was read, an early stop keeps the stored one
+            if rss is not None and not rss.get("stopped"):
+                cache["content_hash"] = hasher.hexdigest()
+        if rss is None:
+            frappe.msgprint(_("Invalid XML"))
+            return
+        records = rss.get("records")
+        if not records:
+            # Reached the newest item of the previous fetch straight away, nothing is new
+            if rss.get("stopped"):
+                cache["unchanged"] = True
+                return {"payload": {"url": url}, "response": response, "content": content, "feeds": None, "cache": cache}
             frappe.msgprint(_("No records found"))
             return
-        for item in rss:
+        cache["last_item"] = key(records[0])
+        for item in records:
             feeds.append({
                 "title": item.get("title"),
                 "description": item.get("content") or item.get("description"),
                 "url": item.get("link")
             })
     # Must return in this format
-    return {"payload": {"url": url}, "response": response, "feeds": feeds}
+    return {"payload": {"url": url}, "response": response, "content": content, "feeds": feeds, "cache": cache}
 
 
 
@@ -50,34 +114,118 @@ def parse(xml=""):
 
     results = []
 
-    tag = root.tag.replace("{http://www.w3.org/2005/Atom}", "")
+    tag = root.tag.replace(ATOM, "")
 
     # Check if root is Atom or RSS
-    records = root.findall("{http://www.w3.org/2005/Atom}entry") if tag == "feed" else root.find("channel").findall("item") if tag == "rss" else None
+    records = root.findall(f"{ATOM}entry") if tag == "feed" else root.find("channel").findall("item") if tag == "rss" else None
 
     for record in records:
-        record_data = {}
         if len(record) > 0:
-            for child in record:
-                tag = child.tag.replace("{http://www.w3.org/2005/Atom}", "")
-                # Make sure to collect only required data
-                if tag not in ["title", "content", "description", "link"]:
-                    continue
-                if tag == "link":
-                    link = child.get("href") or child.text or ""  # Retrieve the 'href' attribute value
-                    # Check if the link starts with `https://www.google.com/url`, this means that the link is a Google redirect link
-                    if link.startswith("https://www.google.com/url"):
-                        parsed_url = urlparse(link)
-                        query_params = parse_qs(parsed_url.query)
-                        link = query_params.get('url', [''])[0]
-                    record_data[tag] = link
-                else:
-                    record_data[tag] = decode(child.text)
-            results.append(record_data)
+            results.append(read_record(record))
 
     return results
 
 
+# Parse RSS/Atom from an iterable of byte chunks without building the whole tree.
+# Each entry is cleared as soon as it has been read, and parsing stops at the entry whose key equals `stop_at`.
+# The stop is only trusted when the first two entries are dated newest-first, oldest-first or pinned-first feeds are parsed whole.
+# Returns {"records": [...], "stopped": bool} or None if the XML is invalid.
+def parse_stream(chunks, stop_at=None):
+    parser = ET.XMLPullParser(events=("start", "end"))
+    results = []
+    tag = None
+    parent = None
+    # Position of the `stop_at` entry, and whether the feed is newest-first (None until two entries were read)
+    stop = None
+    ordered = None
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == "start":
+                    # Entries live directly inside the Atom feed or the RSS channel
+                    if tag is None:
+                        tag = element.tag.replace(ATOM, "")
+                        parent = element if tag == "feed" else None
+                    elif tag == "rss" and parent is None and element.tag == "channel":
+                        parent = element
+                    continue
+                if parent is None or not ((tag == "feed" and element.tag == f"{ATOM}entry") or (tag == "rss" and element.tag == "item")):
+                    continue
+                record_data = read_record(element) if len(element) > 0 else None
+                # Free the entry as soon as it has been read
+                element.clear()
+                if element in parent:
+                    parent.remove(element)
+                if record_data is None:
+                    continue
+                results.append(record_data)
+                if ordered is None and len(results) == 2:
+                    ordered = newest_first(results[0], results[1])
+                if stop is None and stop_at and key(record_data) == stop_at:
+                    stop = len(results) - 1
+                if stop is not None and ordered:
+                    return {"records": results[:stop], "stopped": True}
+        parser.close()
+    except ET.ParseError:
+        return
+
+    return {"records": results, "stopped": False}
+
+
+def read_record(record):
+    record_data = {}
+    for child in record:
+        tag = child.tag.replace(ATOM, "")
+        # Make sure to collect only required data
+        if tag not in ["title", "content", "description", "link", "pubDate", "updated", "published"]:
+            continue
+        if tag in ["pubDate", "updated", "published"]:
+            # Atom has both, `updated` wins
+            if tag != "published" or "date" not in record_data:
+                record_data["date"] = (child.text or "").strip()
+            continue
+        if tag == "link":
+            link = child.get("href") or child.text or ""  # Retrieve the 'href' attribute value
+            # Check if the link starts with `https://www.google.com/url`, this means that the link is a Google redirect link
+            if link.startswith("https://www.google.com/url"):
+                parsed_url = urlparse(link)
+                query_params = parse_qs(parsed_url.query)
+                link = query_params.get('url', [''])[0]
+            record_data[tag] = link
+        else:
+            record_data[tag] = decode(child.text or "")
+    return record_data
+
+
+# Whether `first` is dated no older than `second`, False when either date is missing or unreadable
+def newest_first(first, second):
+    first, second = date(first), date(second)
+    return bool(first and second and first >= second)
+
+
+# RSS dates are RFC 822, Atom dates are RFC 3339. Dates without a time zone are taken as UTC.
+def date(record):
+    value = record.get("date")
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+# Identify a record across fetches
+def key(record):
+    return record.get("link") or record.get("title")
+
+
 def decode(text):
     # Unescape
     text = html.unescape(text)
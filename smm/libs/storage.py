@@ -0,0 +1,108 @@
+import hashlib
+import io
+
+import frappe
+import PIL
+
+from . import utils
+
+FOLDER = "Home/SMM"
+
+# Redis hash of perceptual hash -> file URL, used to find near-duplicate images
+PHASH_KEY = "smm:image_phash"
+
+
+# Content-addressed image store.
+# Images are stored once under the SHA-256 of their source bytes and conversion options. Storing the same bytes again only adds
+# a File record pointing at the existing file URL, so every attachment counts as one reference and the file on disk is removed
+# together with its last reference. Returns the file URL.
+def save(content, dt=None, dn=None, df="image", format="PNG", quality=None, max_width=None):
+    format = (format or "PNG").upper()
+    extension = "jpg" if format == "JPEG" else format.lower()
+    hasher = hashlib.sha256(content)
+    # The same source converted differently is a different file
+    hasher.update(f"{format}:{quality or ''}:{max_width or ''}".encode("utf-8"))
+    file_name = f"{hasher.hexdigest()}.{extension}"
+
+    file_url = frappe.db.get_value("File", {"file_name": file_name, "is_folder": 0}, "file_url")
+
+    # Look for a near-duplicate when perceptual hashing is enabled
+    phash = None
+    if not file_url and utils.conf("image_phash_distance"):
+        phash = perceptual_hash(content)
+        file_url = similar(phash, utils.conf("image_phash_distance"))
+
+    if file_url:
+        attach(file_url, file_name, dt, dn, df)
+        return file_url
+
+    content, extension = utils.convert_image(content, format=format, quality=quality, max_width=max_width)
+    utils.check_folder(name="SMM")
+    file = frappe.utils.file_manager.save_file(
+        file_name,
+        content,
+        dt=dt,
+        dn=dn,
+        df=df,
+        folder=FOLDER,
+        decode=False,
+        is_private=False,
+    )
+    if phash:
+        frappe.cache().hset(PHASH_KEY, phash, file.get("file_url"))
+    return file.get("file_url")
+
+
+# Add a reference from a document to an already stored file
+def attach(file_url, file_name, dt=None, dn=None, df=None):
+    if frappe.db.exists("File", {"file_url": file_url, "attached_to_doctype": dt, "attached_to_name": dn, "attached_to_field": df}):
+        return
+    frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "file_url": file_url,
+        "attached_to_doctype": dt,
+        "attached_to_name": dn,
+        "attached_to_field": df,
+        "folder": FOLDER,
+        "is_private": 0,
+    }).insert(ignore_permissions=True)
+
+
+# Number of File records referencing the stored file
+def references(file_url):
+    return frappe.db.count("File", {"file_url": file_url, "is_folder": 0})
+
+
+# Drop the references of a document. A file is deleted from disk once nothing references it anymore.
+def release(dt, dn, df=None, keep=None):
+    filters = {"attached_to_doctype": dt, "attached_to_name": dn, "folder": FOLDER}
+    if df:
+        filters["attached_to_field"] = df
+    if keep:
+        filters["file_url"] = ["not in", keep]
+    for file in frappe.get_all("File", filters=filters, fields=["name", "file_url"]):
+        frappe.delete_doc("File", file.name, ignore_permissions=True)
+        if not references(file.file_url):
+            for key, file_url in (frappe.cache().hgetall(PHASH_KEY) or {}).items():
+                if file_url == file.file_url:
+                    frappe.cache().hdel(PHASH_KEY, key)
+
+
+# 64-bit difference hash, similar images have hashes with a small Hamming distance
+def perceptual_hash(content):
+    image = PIL.Image.open(io.BytesIO(content)).convert("L").resize((9, 8))
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return f"{bits:016x}"
+
+
+def similar(phash, distance):
+    stored = frappe.cache().hgetall(PHASH_KEY) or {}
+    target = int(phash, 16)
+    for key, file_url in stored.items():
+        if bin(int(key, 16) ^ target).count("1") <= int(distance):
+            return file_url
@@ -3,10 +3,9 @@ from typing import List
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 
-from . import utils
+from . import http, utils
 
 
 class TelegramBot:
@@ -28,7 +27,7 @@ class TelegramBot:
         if method == "GET" and not request:
             return url + "?" + urlencode(params)
         if request:
-            return requests.request(method, url, params=params, data=data, json=json, headers=headers, files=files)
+            return http.request(method, url, params=params, data=data, json=json, headers=headers, files=files)
 
     def send_message(self, chat_id: str, text: str, extra_payload={}):
         """
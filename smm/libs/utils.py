@@ -1,7 +1,9 @@
+import hashlib
 import io
 import json
 import re
 from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import frappe
 import PIL
@@ -15,12 +17,33 @@ def find(args, key, default=None):
     data = args.get(key)
     return data if data is not None else (data := doc_data(args)) and data.get(key) if doc_data(args) else default
 
+# Get SMM setting from site config. Example: `conf("fetch_workers")` reads `smm_fetch_workers` from site_config.json
+def conf(key, default=None):
+    value = frappe.conf.get(f"smm_{key}")
+    return value if value is not None else default
+
 # Get the duration between two datetime objects. Returns Integer.
 def duration(time, unit="second", format="%Y-%m-%d %H:%M:%S.%f"):
     time = datetime.strptime(time, format) if isinstance(time, str) else time if isinstance(time, datetime) else None
     return None if not isinstance(time, datetime) else int((datetime.now() - time).total_seconds() / 60) if unit == "minute" else int((datetime.now() - time).total_seconds())
 
 
+# Normalize URL so that trivial variants (case of scheme and host, fragment, tracking parameters, trailing slash) compare equal.
+def canonical_url(url):
+    if not url:
+        return ""
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not key.lower().startswith("utm_")))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+
+# Stable SHA-1 fingerprint of a Feed, computed from canonical URL and normalized title.
+def fingerprint(url=None, title=None):
+    title = re.sub(r"\s+", " ", title or "").strip().casefold()
+    return hashlib.sha1(f"{canonical_url(url)}\n{title}".encode("utf-8")).hexdigest()
+
+
 def remove_quotes(text):
     if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
         return text[1:-1]
@@ -147,3 +170,23 @@ def to_png(content):
     content.save(buffer, "PNG")
     buffer.seek(0)  # Ensure pointer is at the start of the file
     return buffer.getvalue()
+
+
+# Encode image bytes to `format` (PNG, WEBP or JPEG), optionally downscaled to `max_width`.
+# PNG content that doesn't need resizing is returned as is, without decoding it.
+# Returns (content, extension).
+def convert_image(content, format="PNG", quality=None, max_width=None):
+    format = (format or "PNG").upper()
+    if format == "PNG" and not max_width and content[:8] == b"\x89PNG\r\n\x1a\n":
+        return content, "png"
+    image = PIL.Image.open(io.BytesIO(content))
+    if max_width and image.width > int(max_width):
+        image.thumbnail((int(max_width), int(image.height * int(max_width) / image.width)))
+    options = {}
+    if format in ["WEBP", "JPEG"]:
+        options["quality"] = int(quality or 85)
+    if format == "JPEG" and image.mode not in ["RGB", "L"]:
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue(), "jpg" if format == "JPEG" else format.lower()
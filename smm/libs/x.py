@@ -10,10 +10,9 @@ import time
 from urllib.parse import quote, urlencode
 
 import frappe
-import requests
 from frappe import _
 
-from . import utils
+from . import http, utils
 
 
 class X:
@@ -144,7 +143,7 @@ refresh_token=None, scope=[], authorization_type=None, content_type=None, versio
         if method == "GET" and not request:
             return url + "?" + urlencode(params)
         if request:
-            return requests.request(method, url, params=params, data=data, json=json, headers=headers, files=files)
+            return http.request(method, url, params=params, data=data, json=json, headers=headers, files=files)
 
     # Returns authorization URL, state, code_verifier, code_challenge, code_challenge_method
     def authorize(self, redirect_uri=None, scope=[], state=None, code_verifier=None, code_challenge=None, code_challenge_method="S256"):
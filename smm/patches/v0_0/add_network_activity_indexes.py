@@ -0,0 +1,6 @@
+from ...smm.doctype.network_activity.network_activity import on_doctype_update
+
+
+def execute():
+	# Existing sites get the composite indexes of the hot Network Activity queries
+	on_doctype_update()
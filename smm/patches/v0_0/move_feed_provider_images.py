@@ -0,0 +1,26 @@
+import json
+
+import frappe
+
+from ...libs import feed
+
+
+def execute():
+	# Move base64 screenshots out of the `feeds` JSON of Feed Providers.
+	# Virtual providers keep a reference to a stored file, the others already store images in their Feeds.
+	for name in frappe.get_all("Feed Provider", filters={"feeds": ["like", '%"image"%']}, pluck="name"):
+		provider = frappe.db.get_value("Feed Provider", name, ["virtual", "feeds"], as_dict=True)
+		try:
+			feeds = json.loads(provider.feeds)
+		except ValueError:
+			continue
+		if not isinstance(feeds, list):
+			continue
+		if provider.virtual:
+			feed.store_images(feeds, name)
+		else:
+			for item in feeds:
+				if isinstance(item, dict) and item.get("image") and not str(item.get("image")).startswith("/"):
+					item.pop("image")
+		frappe.db.set_value("Feed Provider", name, "feeds", json.dumps(feeds, indent=4), update_modified=False)
+		frappe.db.commit()
@@ -0,0 +1,16 @@
+import frappe
+
+from ...libs import utils
+
+
+def execute():
+	# Backfill fingerprints of existing Feeds. Duplicates keep an empty fingerprint so the unique index still holds.
+	seen = set(frappe.get_all("Feed", filters={"fingerprint": ["is", "set"]}, pluck="fingerprint"))
+	feeds = frappe.get_all("Feed", filters={"fingerprint": ["is", "not set"]}, fields=["name", "title", "url"], order_by="creation asc")
+	for feed in feeds:
+		fingerprint = utils.fingerprint(feed.url, feed.title)
+		if fingerprint in seen:
+			continue
+		seen.add(fingerprint)
+		frappe.db.set_value("Feed", feed.name, "fingerprint", fingerprint, update_modified=False)
+	frappe.db.commit()
@@ -0,0 +1,12 @@
+import datetime
+
+import frappe
+
+
+def execute():
+	# Schedule existing Feed Providers from their last fetch
+	now = frappe.utils.now_datetime()
+	for provider in frappe.get_all("Feed Provider", filters={"next_fetch_at": ["is", "not set"]}, fields=["name", "duration", "fetched"]):
+		next_fetch_at = provider.fetched + datetime.timedelta(seconds=provider.duration or 0) if provider.fetched else now
+		frappe.db.set_value("Feed Provider", provider.name, {"next_fetch_at": next_fetch_at, "effective_duration": provider.duration}, update_modified=False)
+	frappe.db.commit()
@@ -4,6 +4,12 @@
 # import frappe
 from frappe.model.document import Document
 
+from ....libs import utils
+
 
 class Feed(Document):
-	pass
+	def validate(self):
+		self.update_fingerprint()
+
+	def update_fingerprint(self):
+		self.fingerprint = utils.fingerprint(self.url, self.title)
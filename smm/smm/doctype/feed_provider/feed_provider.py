@@ -1,9 +1,21 @@
 # Copyright (c) 2023, MIMIZA and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class FeedProvider(Document):
-	pass
+	def validate(self):
+		self.update_schedule()
+
+	def update_schedule(self):
+		# New providers and providers whose duration changed are due right away and restart from Duration
+		if self.is_new() or self.has_value_changed("duration") or self.has_value_changed("min_duration") or self.has_value_changed("max_duration"):
+			self.effective_duration = self.duration
+			self.next_fetch_at = frappe.utils.now_datetime()
+		# Enabling a provider lifts its quarantine
+		if self.has_value_changed("enabled") and self.enabled:
+			self.failures = 0
+			self.quarantined_until = None
+			self.next_fetch_at = frappe.utils.now_datetime()
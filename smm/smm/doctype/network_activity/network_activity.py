@@ -18,3 +18,21 @@ class NetworkActivity(Document):
         title += f" [{self.type}]" if self.type else ""
         title += f" {mechanism.title}" if mechanism.title else ""
         self.title = title
+
+
+# Composite indexes of the hot Network Activity queries, created on migrate and by the `add_network_activity_indexes` patch
+INDEXES = {
+	# process_activities, cast_activities, lease reclaim: status, enabled and a schedule range
+	"status_enabled_schedule": ["status", "enabled", "schedule"],
+	# ActivityPlan slot planner: latest schedule per agent of a plan
+	"plan_agent_schedule": ["plan", "agent", "schedule"],
+	# ActivityPlan.plan_query: successful posts of a plan
+	"plan_type_status": ["plan", "type", "status"],
+	# ActivityPlan.plan_query: activities an agent already engaged with
+	"agent_type_status_activity": ["agent", "type", "status", "activity"],
+}
+
+
+def on_doctype_update():
+	for name, fields in INDEXES.items():
+		frappe.db.add_index("Network Activity", fields, index_name=name)
@@ -1,9 +1,62 @@
 # Copyright (c) 2023, MIMIZA and Contributors
 # See license.txt
 
-# import frappe
+import datetime
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from smm.libs import activity
+from smm.tasks import activity as tasks
+
+PLAN_PREFIX = "_Test Explain Plan"
+
 
 class TestNetworkActivity(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		# Seed enough rows for the optimizer to prefer an index over a full scan
+		now = frappe.utils.now_datetime()
+		statuses = ["Success"] * 8 + ["Pending", "Failed"]
+		types = ["Post Content", "Post Comment", "Share Content"]
+		fields = ["name", "owner", "creation", "modified", "modified_by", "docstatus", "enabled", "plan", "agent", "type", "status", "schedule"]
+		values = []
+		for index in range(20000):
+			values.append((
+				f"_Test Explain {index}", "Administrator", now, now, "Administrator", 0, 1,
+				f"{PLAN_PREFIX} {index % 100}", f"_Test Explain Agent {index % 200}",
+				types[index % 3], statuses[index % 10], now - datetime.timedelta(minutes=index)
+			))
+		frappe.db.bulk_insert("Network Activity", fields, values)
+		frappe.db.sql("analyze table `tabNetwork Activity`")
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.delete("Network Activity", {"plan": ["like", f"{PLAN_PREFIX}%"]})
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def test_hot_queries_use_indexes(self):
+		now = frappe.utils.now_datetime()
+		start = now - datetime.timedelta(hours=1)
+		params = {
+			"now": now,
+			"plan": f"{PLAN_PREFIX} 1",
+			"agents": ("_Test Explain Agent 1", "_Test Explain Agent 2"),
+		}
+		# The queries the scheduler and the plan generator issue, each must use an index instead of scanning the table
+		queries = {
+			"process_activities": tasks.content_query(start, now + datetime.timedelta(hours=1), run=False),
+			"cast_activities": tasks.cast_query(start, now).get_sql(),
+			"reclaim": activity.RECLAIM_QUERY,
+			"slot_planner": activity.slots_query(activity.slot_fields("Post Content")),
+			"slot_planner_linked": activity.slots_query(activity.slot_fields("Post Comment")),
+			"plan_query": activity.ENGAGEMENTS_QUERY,
+		}
+		for name, query in queries.items():
+			with self.subTest(query=name):
+				plan = frappe.db.sql(f"explain {query}", params, as_dict=True)
+				# `ALL` scans the table, `index` scans a whole index
+				scans = [row for row in plan if row.get("type") in ("ALL", "index")]
+				self.assertFalse(scans, f"{name} scans the whole table: {plan}")
@@ -1,9 +1,11 @@
 # Copyright (c) 2023, MIMIZA and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class NetworkActivityPlan(Document):
-	pass
+	def validate(self):
+		# A changed plan is evaluated again on the next `process_plans` tick
+		self.next_evaluation_at = frappe.utils.now_datetime()
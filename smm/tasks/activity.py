@@ -1,9 +1,11 @@
 import frappe
-from ..libs import activity
+from ..libs import activity, dispatcher, lock, pool, utils
 import datetime
+import time
 
 
 @frappe.whitelist()
+@lock.single_flight()
 def process_plans():
     # Get current date and time using Frappe Utils then convert it to timedelta
     current_datetime = datetime.datetime.strptime(frappe.utils.now(), "%Y-%m-%d %H:%M:%S.%f")
@@ -12,8 +14,10 @@ def process_plans():
 
     doctype = frappe.qb.DocType("Network Activity Plan")
 
+    # Only plans whose inputs changed or whose evaluation is due, see `activity.mark_plans`
     network_activity_plans = frappe.qb.from_(doctype).select("name").distinct().where(
         (doctype.enabled == True) &
+        (doctype.next_evaluation_at.isnull() | (doctype.next_evaluation_at <= current_datetime)) &
         (
             doctype.start_date.isnull() |
             (
@@ -49,52 +53,100 @@ def process_plans():
 
 
 @frappe.whitelist()
+@lock.single_flight()
 def process_activities():
+    # Activities left Processing by a dead worker are due again
+    activity.reclaim()
+
     # Get current date and time using Frappe Utils then convert it to timedelta
     current_datetime = datetime.datetime.strptime(frappe.utils.now(), "%Y-%m-%d %H:%M:%S.%f")
     start_datetime = current_datetime - datetime.timedelta(hours=1)
     end_datetime = current_datetime + datetime.timedelta(hours=1)
 
-    network_activities = frappe.db.get_list(
-        "Network Activity",
-        filters=[
-            ["schedule", ">=", start_datetime],
-            ["schedule", "<=", end_datetime],
-            ["enabled", "=", True],
-            ["status", "=", "Pending"],
-            ["content", "is", "not set"]
-        ],
-        fields=["name", "schedule"],
-        order_by="schedule asc",
-        limit_page_length=1
+    network_activities = content_query(start_datetime, end_datetime)
+
+    # Earliest schedules are claimed first, each activity is leased by `activity.generate_content`
+    started = time.monotonic()
+    results = pool.map(
+        lambda item: activity.generate_content(name=item.name),
+        network_activities,
+        workers=utils.conf("content_workers", 1)
     )
 
-    for item in network_activities:
-        activity.generate_content(name=item.name)
+    logger = frappe.logger("smm")
+    for result in results:
+        item = result.get("item")
+        item.latency = round(result.get("elapsed"), 3)
+        item.error = str(result.get("error")) if result.get("error") else None
+        logger.info(f"Network Activity {item.name} content generated in {item.latency}s" + (f" with error: {item.error}" if item.error else ""))
+    if results:
+        logger.info(f"Generated content for {len(results)} Network Activities in {round(time.monotonic() - started, 3)}s")
 
     return network_activities
 
 
 @frappe.whitelist()
+@lock.single_flight()
 def cast_activities():
+    # Activities left Processing by a dead worker are due again
+    activity.reclaim()
+
+    # The dispatcher casts activities at their schedule, see `dispatcher.run`
+    if dispatcher.enabled():
+        return []
+
     # Get current date and time using Frappe Utils then convert it to timedelta
     current_datetime = datetime.datetime.strptime(frappe.utils.now(), "%Y-%m-%d %H:%M:%S.%f")
-    start_datetime = current_datetime - datetime.timedelta(hours=1)
-    network_activities = frappe.db.get_list(
+    start_datetime = current_datetime - dispatcher.LOOK_BACK
+    network_activities = cast_query(start_datetime, current_datetime).run(as_dict=True)
+
+    started = time.monotonic()
+    results = activity.cast_batch(network_activities, workers=utils.conf("cast_workers", 1))
+
+    logger = frappe.logger("smm")
+    for result in results:
+        item = result.get("item")
+        item.latency = round(result.get("elapsed"), 3)
+        item.error = str(result.get("error")) if result.get("error") else None
+        logger.info(f"Network Activity {item.name} cast in {item.latency}s" + (f" with error: {item.error}" if item.error else ""))
+    if results:
+        logger.info(f"Cast {len(results)} Network Activities in {round(time.monotonic() - started, 3)}s")
+
+    return network_activities
+
+
+# Activities in the look-ahead window that still need content, earliest schedule first. `run=False` returns the SQL.
+def content_query(start_datetime, end_datetime, run=True):
+    return frappe.db.get_list(
         "Network Activity",
         filters=[
             ["schedule", ">=", start_datetime],
-            ["schedule", "<=", current_datetime],
+            ["schedule", "<=", end_datetime],
             ["enabled", "=", True],
             ["status", "=", "Pending"],
-            ["content", "is", "set"]
+            ["content", "is", "not set"]
         ],
-        fields=["name", "agent", "content", "schedule"],
+        fields=["name", "schedule"],
         order_by="schedule asc",
-        limit_page_length=1
+        limit_page_length=utils.conf("content_batch_size", 1),
+        run=run
     )
 
-    for item in network_activities:
-        activity.cast(**item)
 
-    return network_activities
+# Activities due in the last hour, plus retries whose back-off is over, see `activity.retry`
+def cast_query(start_datetime, current_datetime):
+    doctype = frappe.qb.DocType("Network Activity")
+    query = frappe.qb.from_(doctype).select(doctype.name, doctype.agent, doctype.content, doctype.schedule).where(
+        (doctype.enabled == True) &
+        (doctype.status == "Pending") &
+        doctype.content.isnotnull() &
+        (doctype.content != "") &
+        (doctype.schedule <= current_datetime) &
+        (
+            ((doctype.schedule >= start_datetime) & doctype.next_attempt_at.isnull()) |
+            (doctype.next_attempt_at <= current_datetime)
+        )
+    ).orderby(doctype.schedule)
+    if utils.conf("cast_batch_size", 0):
+        query = query.limit(utils.conf("cast_batch_size", 0))
+    return query
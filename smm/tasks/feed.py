@@ -1,19 +1,52 @@
+import random
+import time
+from urllib.parse import urlparse
+
 import frappe
-import datetime
-from ..libs import feed
+
+from ..libs import feed, lock, pool, utils
 
 
 @frappe.whitelist()
+@lock.single_flight()
 def fetch_all():
-    feed_providers = frappe.db.get_list("Feed Provider", fields=["name", "virtual", "duration", "fetched"], order_by="fetched asc")
-    current_datetime = datetime.datetime.strptime(frappe.utils.now(), "%Y-%m-%d %H:%M:%S.%f")
-    for feed_provider in feed_providers:
-        # Convert duration to timedelta
-        duration = datetime.timedelta(seconds=feed_provider.duration) if feed_provider.duration else datetime.timedelta()
-        # Get next fetch datetime
-        next_fetch = feed_provider.fetched + duration if feed_provider.fetched else None
-        # If never fetched before or next fetch datetime is less than or equal to current datetime, fetch
-        if next_fetch is None or next_fetch <= current_datetime:
-            feed.fetch(name=feed_provider.name)
-            frappe.db.commit()
-    return feed_providers
\ No newline at end of file
+    started = time.monotonic()
+    # Providers are due when their adaptive schedule says so, see `feed.schedule`
+    due = frappe.get_all(
+        "Feed Provider",
+        filters=[
+            ["enabled", "=", True],
+            ["next_fetch_at", "<=", frappe.utils.now_datetime()]
+        ],
+        fields=["name", "virtual", "duration", "fetched"],
+        order_by="next_fetch_at asc"
+    )
+
+    # Pick the URL of each provider up front so that concurrent fetches can be capped per host
+    urls = {}
+    if due:
+        for item in frappe.get_all("Feed Provider URL Item", filters={"parenttype": "Feed Provider", "parent": ["in", [item.name for item in due]]}, fields=["parent", "url"]):
+            urls.setdefault(item.parent, []).append(item.url)
+    for feed_provider in due:
+        feed_provider.url = random.choice(urls.get(feed_provider.name)) if urls.get(feed_provider.name) else None
+
+    results = pool.map(
+        lambda feed_provider: feed.fetch(name=feed_provider.name, url=feed_provider.url),
+        due,
+        workers=utils.conf("fetch_workers", 1),
+        key=lambda feed_provider: urlparse(feed_provider.url or "").hostname,
+        limit=utils.conf("fetch_host_limit", 2)
+    )
+
+    # Report per-provider latency and the wall time of the whole tick
+    logger = frappe.logger("smm")
+    for result in results:
+        feed_provider = result.get("item")
+        feed_provider.latency = round(result.get("elapsed"), 3)
+        feed_provider.error = str(result.get("error")) if result.get("error") else None
+        if feed_provider.error:
+            feed.failed(feed_provider.name)
+        logger.info(f"Feed Provider {feed_provider.name} fetched in {feed_provider.latency}s" + (f" with error: {feed_provider.error}" if feed_provider.error else ""))
+    logger.info(f"Fetched {len(results)} Feed Providers in {round(time.monotonic() - started, 3)}s")
+
+    return due
@@ -1,12 +1,16 @@
 import frappe
-from ..libs import x as client, utils
+from ..libs import lock, x as client, utils
 
 
 @frappe.whitelist()
+@lock.single_flight()
 def refresh_access_tokens():
     agents = frappe.db.get_list("Agent", filters={"provider": "X"}, fields=["name", "modified"], order_by="modified asc")
     for agent in agents:
         duration = utils.duration(agent.modified)
         if (duration >= 0):
-            client.refresh_access_token(name=agent.name)
+            # Don't rotate tokens while the agent is publishing
+            with lock.hold(f"agent:{agent.name}") as acquired:
+                if acquired:
+                    client.refresh_access_token(name=agent.name)
     return agents
\ No newline at end of file